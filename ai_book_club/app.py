@@ -1,23 +1,29 @@
-import streamlit as st
 import time
+IMPORT_START = time.time()
+
+import streamlit as st
 import uuid
 
-from app_rag import get_answer, categories, get_category
+from app_rag import get_answer_stream, schedule_evaluation, warm_up, get_authors, categories, get_category
 from db import (
     init_db,
     save_conversation,
+    update_relevance,
     save_feedback,
     get_recent_conversations,
     get_feedback_stats,
 )
-from ingest import fetch_documents
 
 def print_log(message):
     print(message, flush=True)
 
+print_log(f"App modules imported in {time.time() - IMPORT_START:.2f}s")
+
 
 def main():
     print_log("Starting the AI Book Club application")
+    # embedding model, clients, indexes: loaded in background once per process, not by the first question
+    warm_up()
     st.set_page_config(
         page_title="AI Book Club",
         page_icon="📚",
@@ -47,10 +53,9 @@ def main():
     )
     print_log(f"User selected category: {category_choice}")
 
-    documents = fetch_documents()
+    # precomputed by ingest.py, served from memory
     category = get_category(category_choice)
-    authors = [el['author'] for el in documents if el['category']==category]
-    authors = sorted(list(set(authors)))
+    authors = get_authors(category)
 
     author_choice = st.selectbox(
         "Select author:",
@@ -99,10 +104,11 @@ def main():
             print_log(f"Getting answer from LLM assistant using {model_choice} model and {search_type} search")
             start_time = time.time()
             try:
-                answer_data = get_answer(user_input, category_choice, author_choice, model_choice, search_type, response_length)
+                # tokens are shown as they are generated
+                answer_stream, answer_data = get_answer_stream(user_input, category_choice, author_choice, model_choice, search_type, response_length)
+                st.write_stream(answer_stream)
                 print_log(f"Answer received in {time.time() - start_time:.2f} seconds")
                 st.success("Completed!")
-                st.write(answer_data["answer"])
             except Exception as e:
                 st.write('Error calling LLM. Please check if you loaded chosen model!')
                 print_log("Error calling LLM. Please check if you loaded chosen model!")
@@ -112,7 +118,11 @@ def main():
             if answer_data:
                 # Display monitoring information
                 st.write(f"Response time: {answer_data['response_time']:.2f} seconds")
+                if answer_data.get("first_token_time") is not None:
+                    st.write(f"Time to first token: {answer_data['first_token_time']:.2f} seconds, {answer_data['tokens_per_second']:.1f} tokens/sec")
                 st.write(f"Relevance: {answer_data['relevance']}")
+                if answer_data.get("gated"):
+                    st.write(f"Answered without LLM: retrieval score {answer_data['retrieval_score']:.3f} is below the gate")
                 st.write(f"Model used: {answer_data['model_used']}")
                 st.write(f"Total tokens: {answer_data['total_tokens']}")
                 if answer_data["openai_cost"] > 0:
@@ -128,6 +138,8 @@ def main():
                         category_choice,
                     )
                     print_log("Conversation saved successfully")
+                    # relevance is evaluated in background, the row is updated when it's done
+                    schedule_evaluation(st.session_state.conversation_id, user_input, answer_data, update_relevance)
                 except Exception as e:
                     st.write('Error saving conversation to database!')
                     print_log('Error saving conversation to database!')
@@ -170,7 +182,7 @@ def main():
 
     # Display recent conversations
     st.subheader("Recent Conversations")
-    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"])
+    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "PENDING"])
     recent_conversations = get_recent_conversations(
         limit=5, relevance=relevance_filter if relevance_filter != "All" else None
     )
@@ -1,11 +1,23 @@
-import os
 import time
+IMPORT_START = time.time()
+
+import os
 import json
+import queue
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
 
 from openai import OpenAI
 
 from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+import numpy as np
+
+import vectorsearch
+import resources
+from es_filters import filter_clauses
+from cache import LRUCache, AnswerCache
+from context_builder import ContextBuilder
+from encoders import load_encoder, encoder_name
 
 
 ELASTIC_URL = os.getenv("ELASTIC_URL", "http://elasticsearch:9200")
@@ -13,17 +25,75 @@ OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434/v1/")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-api-key-here")
 INDEX_MODEL_NAME = os.getenv("INDEX_MODEL_NAME", "multi-qa-MiniLM-L6-cos-v1")
 INDEX_NAME = os.getenv("INDEX_NAME", "book-reviews")
+# "local": in-process vector index saved by ingest.py instead of Elasticsearch kNN
+# "ann": in-process approximate (IVF) index, for large corpora
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "elastic")
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "data/vectors")
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", "data/ann")
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "0")) # 0: as saved by ingest.py
 SEARCH_RESULTS_NUM = 7 # 5
 CONTEXT_NUM = 3
+RRF_K = 60 # reciprocal rank fusion constant for Hybrid search
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024")) # query embeddings, 0 disables
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "3600")) # seconds
+# answers reused for the same retrieved context and the same/paraphrased question
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512")) # contexts, 0 disables
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400")) # seconds
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")) # cosine of questions
+INDEX_VERSION_TTL = int(os.getenv("INDEX_VERSION_TTL", "60")) # seconds between index version checks
+CATALOG_PATH = os.getenv("CATALOG_PATH", "data/catalog.json") # saved by ingest.py
+# relevance is evaluated by background workers after the answer is returned (PENDING until then)
+ASYNC_EVALUATION = os.getenv("ASYNC_EVALUATION", "1") == "1"
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "1")) # concurrent evaluation LLM calls
+EVAL_QUEUE_SIZE = int(os.getenv("EVAL_QUEUE_SIZE", "100"))
+EVAL_RETRIES = int(os.getenv("EVAL_RETRIES", "3"))
+EVAL_RETRY_DELAY = float(os.getenv("EVAL_RETRY_DELAY", "2")) # seconds, doubled on every retry
+EVAL_WAIT_TIMEOUT = float(os.getenv("EVAL_WAIT_TIMEOUT", "60")) # seconds get_answer waits for the evaluation of a cached answer
+# questions whose top retrieval score is below the threshold of the search type get a canned answer
+# without LLM calls, thresholds are tuned with evaluation/calibrate_gate.py, 0 disables the gate
+GATE_THRESHOLDS = {
+    'Text': float(os.getenv("GATE_TEXT_SCORE", "0")), # BM25 score
+    'Vector': float(os.getenv("GATE_VECTOR_SCORE", "0")), # cosine similarity
+    'Hybrid': float(os.getenv("GATE_HYBRID_SCORE", "0")), # cosine similarity of the vector search
+}
 
-es_client = Elasticsearch(ELASTIC_URL)
-ollama_client = OpenAI(base_url=OLLAMA_URL, api_key="ollama")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
 MODEL_NAME = os.getenv("MODEL_NAME") # "ollama/phi3.5" # openai/gpt-4o-mini
 
 categories = {"Business & Money":"bm", "Health, Fitness & Dieting":"hfd", "Science & Math":"sm", "Self-Help":"sh"}
 
-index_model = SentenceTransformer(INDEX_MODEL_NAME)
+query_vector_cache = LRUCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+answer_cache = AnswerCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD)
+index_version_cache = LRUCache(maxsize=1, ttl=INDEX_VERSION_TTL)
+catalog_cache = LRUCache(maxsize=1)
+evaluation_queue = queue.Queue(maxsize=EVAL_QUEUE_SIZE)
+evaluation_workers = [] # started on first use
+evaluation_lock = Lock()
+shared_evaluations = {} # id of a cached PENDING answer -> [(conversation_id, on_result)] of its cache hits
+
+# heavy resources are created on first use (or by warm_up), shared by all sessions
+resources.register('es_client', lambda: Elasticsearch(ELASTIC_URL))
+resources.register('ollama_client', lambda: OpenAI(base_url=OLLAMA_URL, api_key="ollama"))
+resources.register('openai_client', lambda: OpenAI(api_key=OPENAI_API_KEY))
+resources.register('index_model', lambda: load_encoder(INDEX_MODEL_NAME)) # ENCODER_BACKEND: torch | torch-int8 | onnx
+resources.register('vector_index', lambda: load_vector_index())
+
+# reviews cut to the context token budget of the model (CONTEXT_TOKENS), see build_prompt
+context_builder = ContextBuilder(
+    encode=lambda texts: resources.get('index_model').encode(texts, batch_size=64),
+    header=lambda doc: document_header(doc),
+)
+
+
+def warm_up(background=True):
+    # what every Vector/Hybrid request needs, the LLM clients are cheap
+    names = ['es_client', 'index_model']
+    if VECTOR_SEARCH in ['local', 'ann']:
+        names.append('vector_index')
+    return resources.warm_up(names, background=background)
+
+
+# runs the vector part of Hybrid search concurrently with the text part
+search_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_WORKERS", "4")))
 
 DEBUG = True
 
@@ -41,9 +111,9 @@ def get_category_name(category_keyword):
     return categories.keys()[0] # as default
 
 
-def elastic_search_text(query, category, index_name=INDEX_NAME):
+def elastic_search_text(query, category, index_name=INDEX_NAME, filters=None):
     if DEBUG:
-        print('elastic_search_text', category)
+        print('elastic_search_text', category, filters)
     search_query = {
         "size": SEARCH_RESULTS_NUM,
         "query": {
@@ -55,24 +125,26 @@ def elastic_search_text(query, category, index_name=INDEX_NAME):
                         "type": "best_fields",
                     }
                 },
-                "filter": {"term": {"category": category}},
+                "filter": filter_clauses(category, filters),
             }
         },
     }
 
-    response = es_client.search(index=index_name, body=search_query)
-    return [hit["_source"] for hit in response["hits"]["hits"]]
+    response = resources.get('es_client').search(index=index_name, body=search_query)
+    hits = response["hits"]["hits"]
+    return [hit["_source"] for hit in hits], [hit["_score"] for hit in hits]
 
 
-def elastic_search_knn(field, vector, category, index_name=INDEX_NAME):
+def elastic_search_knn(field, vector, category, index_name=INDEX_NAME, filters=None):
     if DEBUG:
-        print('elastic_search_knn', category)
+        print('elastic_search_knn', category, filters)
     knn = {
         "field": field,
         "query_vector": vector,
         "k": SEARCH_RESULTS_NUM,
         "num_candidates": 10000,
-        "filter": {"term": {"category": category}},
+        # applied during the knn search: k results matching the filters, not k filtered afterwards
+        "filter": filter_clauses(category, filters),
     }
 
     search_query = {
@@ -80,9 +152,144 @@ def elastic_search_knn(field, vector, category, index_name=INDEX_NAME):
         "_source": ["author", "title", "text", "category", "id"],
     }
 
-    es_results = es_client.search(index=index_name, body=search_query)
+    es_results = resources.get('es_client').search(index=index_name, body=search_query)
+    hits = es_results["hits"]["hits"]
+    # cosine similarity, as local_search_knn (Elasticsearch scores cosine as (1 + cosine) / 2)
+    return [hit["_source"] for hit in hits], [2 * hit["_score"] - 1 for hit in hits]
 
-    return [hit["_source"] for hit in es_results["hits"]["hits"]]
+def fetch_index_version():
+    # set by ingest.py on every completed (full or incremental) ingestion
+    try:
+        mappings = resources.get('es_client').indices.get_mapping(index=INDEX_NAME)
+        version = ",".join(
+            f"{name}:{mapping['mappings'].get('_meta', {}).get('version', '')}"
+            for name, mapping in sorted(mappings.items())
+        )
+    except Exception as e:
+        print_log(f'!! fetch_index_version: {e}')
+        version = 'unknown'
+    if VECTOR_SEARCH in ['local', 'ann']:
+        index_path = ANN_INDEX_PATH if VECTOR_SEARCH == 'ann' else VECTOR_INDEX_PATH
+        meta_path = os.path.join(index_path, 'meta.json')
+        if os.path.exists(meta_path):
+            version += f'|{os.path.getmtime(meta_path)}'
+    return version
+
+def get_index_version():
+    version = index_version_cache.get('version')
+    if version is None:
+        version = fetch_index_version()
+        index_version_cache.put('version', version)
+    return version
+
+
+def load_vector_index():
+    if VECTOR_SEARCH == 'ann':
+        vector_index = vectorsearch.IVFIndex.load(ANN_INDEX_PATH, mmap=True)
+        vector_index.nprobe = ANN_NPROBE or vector_index.nprobe
+        return vector_index
+    return vectorsearch.VectorIndex.load(VECTOR_INDEX_PATH, mmap=True)
+
+def load_catalog():
+    if os.path.exists(CATALOG_PATH):
+        with open(CATALOG_PATH, 'rt') as f_in:
+            return json.load(f_in)
+    # not ingested with a catalog yet: built from csv files once per index version
+    print_log(f'!! {CATALOG_PATH} not found, building author catalog from csv files')
+    import ingest
+    return ingest.build_catalog(ingest.iter_document_batches())
+
+def get_catalog():
+    # reloaded when the index version changes or ingest.py rewrites the file
+    mtime = os.path.getmtime(CATALOG_PATH) if os.path.exists(CATALOG_PATH) else None
+    key = (get_index_version(), mtime)
+    catalog = catalog_cache.get(key)
+    if catalog is None:
+        catalog = load_catalog()
+        catalog_cache.put(key, catalog)
+    return catalog
+
+def get_authors(category):
+    return list(get_catalog().get(category, {}))
+
+
+def get_vector_index():
+    return resources.get('vector_index')
+
+
+def local_search_knn(vector, category, filters=None):
+    if DEBUG:
+        print('local_search_knn', category, filters)
+    return get_vector_index().search(vector, category, SEARCH_RESULTS_NUM, filters=filters, return_scores=True)
+
+def normalize_query(query):
+    # whitespace and case don't change embeddings of the (uncased) index model
+    return " ".join(query.split()).lower()
+
+def encode_query(query):
+    # repeated questions skip the model entirely
+    key = (encoder_name(INDEX_MODEL_NAME), normalize_query(query))
+    vector = query_vector_cache.get(key)
+    if vector is None:
+        vector = np.asarray(resources.get('index_model').encode(query), dtype=np.float32)
+        vector.setflags(write=False) # shared by all callers
+        query_vector_cache.put(key, vector)
+    if DEBUG:
+        print_log(f'Query vector cache: {query_vector_cache.stats()}')
+    return vector
+
+def vector_search(query, category, filters=None):
+    # (documents, cosine similarities)
+    vector = encode_query(query)
+    if VECTOR_SEARCH in ['local', 'ann']:
+        return local_search_knn(vector, category, filters)
+    return elastic_search_knn('title_text_vector', vector, category, filters=filters)
+
+
+def rrf_merge(result_lists, k=RRF_K):
+    # reciprocal rank fusion: score(doc) = sum of 1 / (k + rank) over the lists containing it
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, 1):
+            scores[doc['id']] = scores.get(doc['id'], 0) + 1 / (k + rank)
+            docs.setdefault(doc['id'], doc)
+    # ties broken by id, so the ranking doesn't depend on the order of lists
+    ids = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+    return [docs[doc_id] for doc_id in ids], [scores[doc_id] for doc_id in ids]
+
+
+def hybrid_search(query, category, filters=None):
+    # vector and text searches run concurrently: latency of the slower one, not the sum
+    vector_future = search_executor.submit(vector_search, query, category, filters)
+    text_results, text_scores = elastic_search_text(query, category, filters=filters)
+    vector_results, vector_scores = vector_future.result()
+    search_results, scores = rrf_merge([vector_results, text_results])
+    if DEBUG:
+        print_log(f'Hybrid: v {len(vector_results)} + t {len(text_results)} -> {len(search_results)}')
+        print_log(f'RRF scores: {[round(score, 4) for score in scores]}')
+    # rrf scores only rank, top scores of the searches tell how well the question matched
+    return search_results, scores, {'Vector': top_score(vector_scores), 'Text': top_score(text_scores)}
+
+
+def top_score(scores):
+    return max(scores) if scores else None
+
+
+def retrieve(query, category, search_type, filters=None):
+    # returns (search results, retrieval score compared to GATE_THRESHOLDS[search_type])
+    if search_type == 'Hybrid':
+        # Improve RAG Retrieval - Hybrid search
+        # vector and text search results combined with reciprocal rank fusion
+        search_results, _, top_scores = hybrid_search(query, category, filters)
+        # TODO ?should we also sort them by helpful_vote?
+        # bm25 scores depend on the question length, cosine similarity is comparable between questions
+        return search_results, top_scores['Vector']
+    elif search_type == 'Vector':
+        search_results, scores = vector_search(query, category, filters)
+    else: # Text
+        search_results, scores = elastic_search_text(query, category, filters=filters)
+    return search_results, top_score(scores)
 
 def response_length_prompt(max_length):
     # simplified - without using additional LLM call, as it is slow with Ollama
@@ -93,7 +300,10 @@ def response_length_prompt(max_length):
     else: #if max_length<=1000:
         return f"Responses should be thorough and well structured, no more than {max_length} words." 
 
-def build_prompt(query, category_choice, search_results, max_length):
+def document_header(doc):
+    return f"\nbook category: {get_category_name(doc['category'])}\nauthor: {doc['author']}\ntitle: {doc['title']}\nreview: "
+
+def build_prompt(query, category_choice, search_results, max_length, model_choice, query_vector):
     # limit max_length
     # simplified user query rewriting to manage output length
     # using parameters like max_tokens doesn't work for all Ollama models
@@ -110,16 +320,19 @@ CONTEXT:
 {context}
 """.strip()
 
+    # whole reviews when they fit in the model budget, else the sentences closest to the question
+    documents, context_tokens = context_builder.build(search_results, query_vector, model_choice)
     context = "\n\n".join(
         [
-            f"\nbook category: {get_category_name(doc['category'])}\nauthor: {doc['author']}\ntitle: {doc['title']}\nreview: {doc['text']}"
-            for doc in search_results
+            document_header(doc) + review
+            for doc, review in documents
         ]
     )
 
     prompt = prompt_template.format(question=query, category_choice=category_choice, context=context, response_limits=response_limits).strip()
     if DEBUG:
-        print_log(f'Search_results: {len(search_results)}')
+        print_log(f'Search_results: {len(search_results)}, context: {len(documents)} doc(s), ~{context_tokens} token(s)')
+        print_log(f'Context builder cache: {context_builder.stats()}')
         print_log(f'Prompt: {max_length} {prompt}')
         # print_log(f'Context: {context}') # DEEP DEBUG
     return prompt
@@ -129,7 +342,7 @@ def llm(prompt, model_choice, max_length=100):
     # TODO max_length in tokens?
     start_time = time.time()
     if model_choice.startswith('ollama/'):
-        response = ollama_client.chat.completions.create(
+        response = resources.get('ollama_client').chat.completions.create(
             model=model_choice.split('/')[-1],
             messages=[{"role": "user", "content": prompt}]
         )
@@ -141,7 +354,7 @@ def llm(prompt, model_choice, max_length=100):
         }
     # TODO add microsoft/phi via HF
     elif model_choice.startswith('openai/'):
-        response = openai_client.chat.completions.create(
+        response = resources.get('openai_client').chat.completions.create(
             model=model_choice.split('/')[-1],
             messages=[{"role": "user", "content": prompt}]
         )
@@ -159,6 +372,57 @@ def llm(prompt, model_choice, max_length=100):
     return answer, tokens, response_time
 
 
+def llm_stream(prompt, model_choice, stats):
+    # yields answer tokens as they are generated, stats gets tokens, response_time,
+    # first_token_time and tokens_per_second when the stream is exhausted
+    start_time = time.time()
+    if model_choice.startswith('ollama/'):
+        client = resources.get('ollama_client')
+    elif model_choice.startswith('openai/'):
+        client = resources.get('openai_client')
+    else:
+        raise ValueError(f"Unknown model choice: {model_choice}")
+    response = client.chat.completions.create(
+        model=model_choice.split('/')[-1],
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    first_token_time = None
+    chunks = 0
+    usage = None
+    for chunk in response:
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            chunks += 1
+            yield content
+
+    response_time = time.time() - start_time
+    if usage:
+        tokens = {
+            'prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens,
+            'total_tokens': usage.total_tokens
+        }
+    else:
+        # server without usage in streams: ~one token per chunk
+        tokens = {'prompt_tokens': 0, 'completion_tokens': chunks, 'total_tokens': chunks}
+    generation_time = response_time - (first_token_time or 0)
+    stats.update(
+        tokens=tokens,
+        response_time=response_time,
+        first_token_time=first_token_time,
+        tokens_per_second=tokens['completion_tokens'] / generation_time if generation_time > 0 else 0,
+    )
+
+
 def evaluate_relevance(question, answer):
     evaluation_prompt_template = """
     You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
@@ -206,6 +470,130 @@ def evaluate_relevance(question, answer):
             return "UNKNOWN", f"Failed to parse evaluation. {evaluation}", tokens
 
 
+def with_retries(function, *args, retries=EVAL_RETRIES, delay=EVAL_RETRY_DELAY):
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print_log(f'!! {function.__name__} failed ({e}), retry {attempt + 1}/{retries}')
+            time.sleep(delay * 2 ** attempt)
+
+
+def run_evaluation(task):
+    try:
+        relevance, explanation, eval_tokens = with_retries(evaluate_relevance, task['question'], task['answer'])
+    except Exception as e:
+        relevance, explanation, eval_tokens = 'UNKNOWN', f'Evaluation failed: {e}', {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    waiting = []
+    if task['cached'] is not None:
+        # cached copy of the answer gets the final relevance too, as do the cache hits waiting for it
+        waiting = complete_evaluation(task['cached'], relevance, explanation)
+        if relevance == 'NON_RELEVANT':
+            answer_cache.remove(task['context_key'], normalize_query(task['question']))
+
+    save_evaluation(task['conversation_id'], task['on_result'], relevance, explanation, eval_tokens)
+    for conversation_id, on_result in waiting:
+        # evaluation LLM tokens are counted once, by the evaluated conversation
+        save_evaluation(conversation_id, on_result, relevance, explanation, {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0})
+    if DEBUG:
+        print_log(f'Evaluated {task["conversation_id"]}: {relevance}, queue {evaluation_queue.qsize()}')
+
+
+def save_evaluation(conversation_id, on_result, relevance, explanation, eval_tokens):
+    def save(*args):
+        # the conversation row may not be saved yet
+        if not on_result(*args):
+            raise LookupError(f"conversation {args[0]} not found")
+    try:
+        with_retries(save, conversation_id, relevance, explanation, eval_tokens)
+    except Exception as e:
+        print_log(f'!! relevance of {conversation_id} not saved: {e}')
+
+
+def complete_evaluation(cached, relevance, explanation):
+    # sets relevance of a cached answer, returns the cache hits waiting for it
+    with evaluation_lock:
+        cached.update(relevance=relevance, relevance_explanation=explanation)
+        return shared_evaluations.pop(id(cached), [])
+
+
+def share_evaluation(cached, conversation_id, on_result):
+    """
+    Saves relevance of a cache hit on an answer that may still be evaluated.
+
+    The evaluation of the cached answer is reused, on_result is called when it's done
+    (right away when it's done already), no second evaluation LLM call is made.
+    """
+    with evaluation_lock:
+        if id(cached) in shared_evaluations:
+            shared_evaluations[id(cached)].append((conversation_id, on_result))
+            return
+        relevance, explanation = cached['relevance'], cached['relevance_explanation']
+    save_evaluation(conversation_id, on_result, relevance, explanation, {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0})
+
+
+def wait_for_evaluation(cached, timeout=EVAL_WAIT_TIMEOUT):
+    # relevance of a cached answer evaluated for another request, (still) PENDING after timeout
+    done = Event()
+    share_evaluation(cached, None, lambda *args: done.set() or True)
+    done.wait(timeout)
+    return cached['relevance'], cached['relevance_explanation']
+
+
+def evaluation_worker():
+    while True:
+        task = evaluation_queue.get()
+        try:
+            run_evaluation(task)
+        finally:
+            evaluation_queue.task_done()
+
+
+def start_evaluation_workers():
+    with evaluation_lock:
+        while len(evaluation_workers) < EVAL_WORKERS:
+            worker = Thread(target=evaluation_worker, name=f'evaluation-{len(evaluation_workers)}', daemon=True)
+            worker.start()
+            evaluation_workers.append(worker)
+
+
+def schedule_evaluation(conversation_id, question, answer_data, on_result):
+    """
+    Queues relevance evaluation of a saved answer with PENDING relevance.
+
+    on_result(conversation_id, relevance, explanation, eval_tokens) stores the result
+    and returns False when the conversation doesn't exist (yet).
+    Returns False when the queue is full, the answer is then left unevaluated.
+    """
+    if answer_data.get('relevance') != 'PENDING':
+        return True
+    if answer_data.get('_context_key') is None and answer_data.get('_cached') is not None:
+        # cache hit on an answer still being evaluated
+        share_evaluation(answer_data['_cached'], conversation_id, on_result)
+        return True
+    start_evaluation_workers()
+    task = {
+        'conversation_id': conversation_id,
+        'question': question,
+        'answer': answer_data['answer'],
+        'cached': answer_data.get('_cached'),
+        'context_key': answer_data.get('_context_key'),
+        'on_result': on_result,
+    }
+    try:
+        evaluation_queue.put_nowait(task)
+        return True
+    except queue.Full:
+        print_log(f'!! evaluation queue full, {conversation_id} not evaluated')
+        explanation = 'Evaluation skipped: queue full'
+        waiting = complete_evaluation(task['cached'], 'UNKNOWN', explanation) if task['cached'] is not None else []
+        for waiting_id, waiting_on_result in [(conversation_id, on_result)] + waiting:
+            waiting_on_result(waiting_id, 'UNKNOWN', explanation, {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0})
+        return False
+
+
 def calculate_openai_cost(model, tokens):
     openai_cost = 0
     # TODO update costs
@@ -217,52 +605,59 @@ def calculate_openai_cost(model, tokens):
     return openai_cost
 
 
-def get_answer(query, category_choice, author_choice, model_choice, search_type, response_length):
+def get_cached_answer(context_key, query):
+    if ANSWER_CACHE_SIZE <= 0:
+        return None, None
+    answer_cache.set_version(get_index_version())
+    vector = encode_query(query)
+    vector = vector / max(np.linalg.norm(vector), 1e-12)
+    answer_data = answer_cache.get(context_key, normalize_query(query), vector)
+    if DEBUG:
+        print_log(f'Answer cache: {answer_cache.stats()}')
+    return answer_data, vector
+
+
+def short_answer(answer, explanation, model_choice, response_time, **extra):
+    # answer_data of a request answered without LLM calls
+    return {
+        'answer': answer,
+        'response_time': response_time,
+        'relevance': 'NON_RELEVANT',
+        'relevance_explanation': explanation,
+        'model_used': model_choice,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'total_tokens': 0,
+        'eval_prompt_tokens': 0,
+        'eval_completion_tokens': 0,
+        'eval_total_tokens': 0,
+        'openai_cost': 0,
+        'first_token_time': None,
+        'tokens_per_second': None,
+        **extra,
+    }
+
+
+def prepare_answer(query, category_choice, author_choice, model_choice, search_type, response_length, start_time, filters=None):
+    # retrieval and prompt, returns (answer_data, None) when no LLM call is needed, else (None, request)
     category = get_category(category_choice)
     if DEBUG:
         print('get_answer category:', category)
 
-    if search_type in ['Vector', 'Hybrid']:
-        vector = index_model.encode(query)
-        search_results = elastic_search_knn('title_text_vector', vector, category)
-        if search_type == "Hybrid":
-            # Improve RAG Retrieval - Hybrid search
-            # in addition to vector also search text and combine
-            tsearch_results = elastic_search_text(query, category)
-            if DEBUG:
-                print_log(f'Hybrid: v {len(search_results)} + t {len(tsearch_results)}')
-                # print(tsearch_results[0])
-                # print(search_results[0])
-            # add only items not present in the current search results 
-            for t in tsearch_results:
-                found = False
-                for v in search_results:
-                    if t['id']==v['id']:
-                        found = True
-                        break
-                if not found:
-                    search_results.append(t)
-            print_log(f'combined de-duplicated: {len(search_results)}')
-            # TODO ?should we also sort them by helpful_vote?
-
-    else: # Text or Hybrid
-        search_results = elastic_search_text(query, category)
-
-    # Simplified Reranking 
-    # sometimes search ranks reviews for other authors' books higher than chosen one
-    # we need to filter out non-relevant reviews 
-    # simplified - without using additional LLM call, as it is slow with Ollama
+    # sometimes search ranks reviews for other authors' books higher than chosen one, they mislead LLM
+    # so the chosen author (and other structured filters, e.g. {'rating': (4, None)}) are applied
+    # by the search itself: all SEARCH_RESULTS_NUM results match instead of few left after post-filtering
+    filters = dict(filters or {})
     if author_choice:
-        # if author is chosen we can filter out non relevant search results as they mislead LLM
-        reranked_results = [doc for doc in search_results if doc['author'] == author_choice]
-    else:
-        reranked_results = search_results
+        filters['author'] = author_choice
+
+    search_results, retrieval_score = retrieve(query, category, search_type, filters)
+    reranked_results = search_results
 
     # TODO ?Add Fuzzy search option in UI?
     # what should we do if 0 search results for a given query? 
-    # stop irrelevant query fast (without calling LLM)?
-    #  or add most helpful reviews for the chosen author anyway 
-    #       and let LLM figure it out
+    #  add most helpful reviews for the chosen author anyway 
+    #       and let LLM figure it out?
     # if len(reranked_results)>0 and <CONTEXT_NUM:
     #   add top reviews to have CONTEXT_NUM  
 
@@ -270,22 +665,29 @@ def get_answer(query, category_choice, author_choice, model_choice, search_type,
         print_log(f'search_results: {len(search_results)}')
         print_log(f'reranked_results: {len(reranked_results)}')
         print_log([doc['id'] for doc in reranked_results])
+        print_log(f'retrieval score: {retrieval_score} (gate: {GATE_THRESHOLDS.get(search_type, 0)})')
 
     if len(reranked_results)==0:
-        return {
-            'answer': f'No relevant results found for this query & author ({author_choice})',
-            'response_time': 0,
-            'relevance': 'NON_RELEVANT',
-            'relevance_explanation': 'All search results not relevant to chosen author '+author_choice,
-            'model_used': model_choice,
-            'prompt_tokens': 0,
-            'completion_tokens': 0,
-            'total_tokens': 0,
-            'eval_prompt_tokens': 0,
-            'eval_completion_tokens': 0,
-            'eval_total_tokens': 0,
-            'openai_cost': 0
-        }    
+        return short_answer(
+            f'No relevant results found for this query & author ({author_choice})' if author_choice
+                else 'No relevant results found for this query',
+            f'No search results matching filters {filters}',
+            model_choice,
+            0,
+        ), None
+
+    # hopeless (e.g. off-topic) question: stop fast, without the answer and evaluation LLM calls
+    threshold = GATE_THRESHOLDS.get(search_type, 0)
+    if threshold and retrieval_score is not None and retrieval_score < threshold:
+        return short_answer(
+            f"Sorry, I couldn't find reviews relevant to this question in {category_choice} category. "
+            "Please try to rephrase it or choose another category or author.",
+            f'Gated: {search_type} retrieval score {retrieval_score:.3f} < {threshold}',
+            model_choice,
+            time.time() - start_time,
+            gated=True,
+            retrieval_score=retrieval_score,
+        ), None
 
     # limit to up to CONTEXT_NUM results
     reranked_results = reranked_results[:min(CONTEXT_NUM, len(reranked_results))]
@@ -298,15 +700,51 @@ def get_answer(query, category_choice, author_choice, model_choice, search_type,
     else: # 'L'
         max_length = 1000
 
-    prompt = build_prompt(query, category_choice, reranked_results, max_length)
+    # same retrieved context and same/paraphrased question: no LLM calls
+    context_key = (category, tuple(sorted(filters.items())), model_choice, response_length, tuple(doc['id'] for doc in reranked_results))
+    cached_answer, query_vector = get_cached_answer(context_key, query)
+    if cached_answer is not None:
+        if cached_answer['relevance'] == 'PENDING':
+            # its evaluation is still running, schedule_evaluation reuses it
+            cached_answer = dict(cached_answer, _cached=cached_answer)
+        return dict(
+            cached_answer,
+            response_time=time.time() - start_time,
+            prompt_tokens=0,
+            completion_tokens=0,
+            total_tokens=0,
+            eval_prompt_tokens=0,
+            eval_completion_tokens=0,
+            eval_total_tokens=0,
+            openai_cost=0,
+            first_token_time=None,
+            tokens_per_second=None,
+            retrieval_score=retrieval_score,
+        ), None
+
+    if query_vector is None: # answer cache disabled
+        query_vector = encode_query(query)
+    prompt = build_prompt(query, category_choice, reranked_results, max_length, model_choice, query_vector)
+    return None, {
+        'prompt': prompt,
+        'max_length': max_length,
+        'context_key': context_key,
+        'query_vector': query_vector,
+        'retrieval_score': retrieval_score,
+    }
 
-    answer, tokens, response_time = llm(prompt, model_choice, max_length)
-    
-    relevance, explanation, eval_tokens = evaluate_relevance(query, answer)
+
+def finish_answer(query, model_choice, request, answer, tokens, response_time, stream_stats=None, evaluate_async=ASYNC_EVALUATION):
+    if evaluate_async:
+        # see schedule_evaluation
+        relevance, explanation = 'PENDING', 'Evaluation pending'
+        eval_tokens = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    else:
+        relevance, explanation, eval_tokens = evaluate_relevance(query, answer)
 
     openai_cost = calculate_openai_cost(model_choice, tokens)
- 
-    return {
+
+    answer_data = {
         'answer': answer,
         'response_time': response_time,
         'relevance': relevance,
@@ -318,5 +756,60 @@ def get_answer(query, category_choice, author_choice, model_choice, search_type,
         'eval_prompt_tokens': eval_tokens['prompt_tokens'],
         'eval_completion_tokens': eval_tokens['completion_tokens'],
         'eval_total_tokens': eval_tokens['total_tokens'],
-        'openai_cost': openai_cost
+        'openai_cost': openai_cost,
+        'first_token_time': (stream_stats or {}).get('first_token_time'),
+        'tokens_per_second': (stream_stats or {}).get('tokens_per_second'),
+        'retrieval_score': request['retrieval_score'],
     }
+    if request['query_vector'] is not None and relevance != 'NON_RELEVANT':
+        # non relevant answers aren't reused, asking again may give a better one
+        cached = dict(answer_data)
+        if relevance == 'PENDING':
+            # cache hits before the evaluation is done wait for it, see share_evaluation
+            with evaluation_lock:
+                shared_evaluations[id(cached)] = []
+        answer_cache.put(request['context_key'], normalize_query(query), request['query_vector'], cached)
+        if relevance == 'PENDING':
+            answer_data['_cached'] = cached
+            answer_data['_context_key'] = request['context_key']
+    return answer_data
+
+
+def get_answer(query, category_choice, author_choice, model_choice, search_type, response_length, filters=None):
+    start_time = time.time()
+    answer_data, request = prepare_answer(query, category_choice, author_choice, model_choice, search_type, response_length, start_time, filters)
+    if answer_data is not None:
+        cached = answer_data.pop('_cached', None)
+        if cached is not None:
+            # the same answer was given moments ago, its evaluation is still running
+            relevance, explanation = wait_for_evaluation(cached)
+            answer_data.update(relevance=relevance, relevance_explanation=explanation)
+        return answer_data
+    # no caller to schedule the evaluation (see schedule_evaluation), it's done here
+    answer, tokens, response_time = llm(request['prompt'], model_choice, request['max_length'])
+    return finish_answer(query, model_choice, request, answer, tokens, response_time, evaluate_async=False)
+
+
+def get_answer_stream(query, category_choice, author_choice, model_choice, search_type, response_length, filters=None):
+    # returns (token generator for st.write_stream, answer_data filled when the generator is exhausted)
+    start_time = time.time()
+    answer_data = {}
+
+    def stream():
+        prepared, request = prepare_answer(query, category_choice, author_choice, model_choice, search_type, response_length, start_time, filters)
+        if prepared is not None:
+            answer_data.update(prepared)
+            yield prepared['answer']
+            return
+        chunks = []
+        stats = {}
+        for token in llm_stream(request['prompt'], model_choice, stats):
+            chunks.append(token)
+            yield token
+        answer = "".join(chunks)
+        answer_data.update(finish_answer(query, model_choice, request, answer, stats['tokens'], stats['response_time'], stats))
+
+    return stream(), answer_data
+
+
+print_log(f'app_rag imported in {time.time() - IMPORT_START:.2f}s')
@@ -0,0 +1,142 @@
+import time
+from threading import Lock
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe least-recently-used cache with optional time-to-live.
+
+    Attributes:
+        maxsize (int): Maximum number of entries, the least recently used one is evicted first.
+        ttl (float): Seconds an entry stays valid, 0 for no expiry.
+        hits (int): Number of get() calls that found a valid entry.
+        misses (int): Number of get() calls that didn't.
+    """
+
+    def __init__(self, maxsize=1024, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class AnswerCache:
+    """
+    Caches answers per retrieval context, reusing them for the same or a paraphrased question.
+
+    Entries are grouped by a context key (e.g. category, author, model, response length and
+    retrieved doc ids). Within a context, a question matches a cached one when it is equal
+    after normalization or when the cosine similarity of their embeddings reaches the threshold.
+    Contexts are evicted least recently used first; everything is dropped when the index version changes.
+
+    Attributes:
+        threshold (float): Minimal cosine similarity of question embeddings.
+        per_context (int): Maximum number of questions kept per context.
+        version: Index version the cached answers come from.
+        hits (int): Number of get() calls that returned an answer.
+        misses (int): Number of get() calls that didn't.
+    """
+
+    def __init__(self, maxsize=1024, ttl=0, threshold=0.95, per_context=8):
+        self.threshold = threshold
+        self.per_context = per_context
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._contexts = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = Lock()
+
+    def set_version(self, version):
+        # answers built from an older index are stale
+        with self._lock:
+            if version != self.version:
+                self._contexts.clear()
+                self.version = version
+
+    def get(self, context_key, question, vector):
+        """
+        Returns the cached answer for a question in a context, or None.
+
+        Args:
+            context_key (hashable): Retrieval context of the answer.
+            question (str): Normalized question.
+            vector (np.ndarray): L2-normalized question embedding.
+        """
+        best_score, best_answer = -1.0, None
+        for cached_question, cached_vector, answer in self._contexts.get(context_key) or []:
+            if cached_question == question:
+                best_score, best_answer = 1.0, answer
+                break
+            score = float(cached_vector @ vector)
+            if score > best_score:
+                best_score, best_answer = score, answer
+        if best_score < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return best_answer
+
+    def put(self, context_key, question, vector, answer):
+        with self._lock:
+            # copy on write, readers iterate the old list without locking
+            entries = [entry for entry in self._contexts.get(context_key) or [] if entry[0] != question]
+            entries.append((question, vector, answer))
+            self._contexts.put(context_key, entries[-self.per_context:])
+
+    def remove(self, context_key, question):
+        with self._lock:
+            entries = self._contexts.get(context_key)
+            if entries:
+                self._contexts.put(context_key, [entry for entry in entries if entry[0] != question])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "contexts": len(self._contexts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "version": self.version,
+        }
@@ -0,0 +1,172 @@
+"""
+Token-budgeted prompt context.
+
+Reviews are added whole while they fit in the context budget of the model. When they don't,
+reviews are split into sentences and the sentences most similar to the question are kept
+(in their original order), so the prompt size is bounded whatever the length of the reviews.
+"""
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from cache import LRUCache
+
+
+# prompt context budget in tokens: headers and reviews of the retrieved documents
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "0")) # 0: per model budgets below
+# prefill time of CPU Ollama models grows with the prompt, OpenAI cost too
+CONTEXT_TOKEN_BUDGETS = {
+    "ollama/llama3.2:1b": 600,
+    "ollama/": 800,
+    "openai/gpt-4o": 1200,
+    "openai/": 1500,
+}
+DEFAULT_CONTEXT_TOKENS = 1000
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "2048")) # documents split and counted
+GAP = "..." # between sentences which aren't consecutive in the review
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def context_budget(model_choice):
+    if CONTEXT_TOKENS:
+        return CONTEXT_TOKENS
+    # exact model first, then provider prefix
+    for prefix in sorted(CONTEXT_TOKEN_BUDGETS, key=len, reverse=True):
+        if model_choice == prefix or (prefix.endswith("/") and model_choice.startswith(prefix)):
+            return CONTEXT_TOKEN_BUDGETS[prefix]
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def approximate_tokens(text):
+    # ~4 characters per token for English with BPE vocabularies, at least one per word
+    return max(len(text.split()), (len(text) + 3) // 4)
+
+
+@lru_cache(maxsize=None)
+def token_counter(model_choice):
+    """
+    Returns (name, count_tokens) for a model: tiktoken for OpenAI models when installed,
+    the approximation otherwise (Ollama models' tokenizers aren't available in the app).
+    """
+    if model_choice.startswith("openai/"):
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model_choice.split("/")[-1])
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            return encoding.name, lambda text: len(encoding.encode(text))
+        except ImportError:
+            pass
+    return "approximate", approximate_tokens
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_END.split(text or "") if sentence.strip()]
+
+
+class ContextBuilder:
+    """
+    Fills a token budget with the retrieved documents.
+
+    Split sentences, their token counts and embeddings are cached per document (and tokenizer),
+    documents retrieved again for other questions aren't tokenized or encoded again.
+
+    Attributes:
+        encode (callable): Texts -> embeddings, same model as the question vector.
+        header (callable): Document -> text preceding its review in the context.
+    """
+
+    def __init__(self, encode, header, cache_size=DOCUMENT_CACHE_SIZE):
+        self.encode = encode
+        self.header = header
+        self._documents = LRUCache(maxsize=cache_size)
+
+    def _document(self, doc, tokenizer, count_tokens):
+        key = (tokenizer, doc["id"], hash(doc["text"]))
+        entry = self._documents.get(key)
+        if entry is None:
+            sentences = split_sentences(doc["text"])
+            entry = {
+                "header_tokens": count_tokens(self.header(doc)),
+                "tokens": count_tokens(doc["text"] or ""),
+                "sentences": sentences,
+                "sentence_tokens": [count_tokens(sentence) for sentence in sentences],
+                "vectors": None, # encoded only when the review has to be cut
+            }
+            self._documents.put(key, entry)
+        return entry
+
+    def _vectors(self, entry):
+        if entry["vectors"] is None and entry["sentences"]:
+            vectors = np.asarray(self.encode(entry["sentences"]), dtype=np.float32)
+            entry["vectors"] = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return entry["vectors"]
+
+    def build(self, docs, query_vector, model_choice, budget=None):
+        """
+        Selects the review text of every document within the context budget.
+
+        Args:
+            docs (list of dict): Retrieved documents, best first.
+            query_vector (np.ndarray): Question embedding.
+            model_choice (str): Model the prompt is for (tokenizer and budget).
+            budget (int): Context tokens, context_budget(model_choice) by default.
+
+        Returns:
+            tuple: (list of (doc, review text) for the documents included, context tokens).
+        """
+        budget = budget or context_budget(model_choice)
+        tokenizer, count_tokens = token_counter(model_choice)
+        entries = [self._document(doc, tokenizer, count_tokens) for doc in docs]
+
+        # headers of documents beyond the budget leave them out, best documents first
+        included = []
+        used = 0
+        for doc, entry in zip(docs, entries):
+            if included and used + entry["header_tokens"] >= budget:
+                break
+            included.append((doc, entry))
+            used += entry["header_tokens"]
+
+        whole = used + sum(entry["tokens"] for _, entry in included)
+        if whole <= budget:
+            return [(doc, doc["text"] or "") for doc, _ in included], whole
+
+        # sentences of all reviews ranked by similarity to the question, each review keeps its best one
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+        ranked = []
+        for i, (_, entry) in enumerate(included):
+            vectors = self._vectors(entry)
+            if vectors is None:
+                continue
+            scores = vectors @ query_vector
+            best = int(np.argmax(scores))
+            ranked.extend((2.0 + score if j == best else score, i, j) for j, score in enumerate(scores.tolist()))
+        ranked.sort(reverse=True)
+
+        selected = [set() for _ in included]
+        for _, i, j in ranked:
+            tokens = included[i][1]["sentence_tokens"][j]
+            if used + tokens <= budget:
+                selected[i].add(j)
+                used += tokens
+
+        context = []
+        for (doc, entry), sentences in zip(included, selected):
+            parts = []
+            previous = None
+            for j in sorted(sentences):
+                if previous is not None and j != previous + 1:
+                    parts.append(GAP)
+                parts.append(entry["sentences"][j])
+                previous = j
+            context.append((doc, " ".join(parts)))
+        return context, used
+
+    def stats(self):
+        return self._documents.stats()
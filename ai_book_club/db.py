@@ -1,24 +1,58 @@
 import os
-import psycopg2
+from threading import BoundedSemaphore
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
+import resources
+
+RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1' # by db_prep.py, not on import
 
 TZ_INFO = os.getenv("TZ", "Europe/Kyiv")
 tz = ZoneInfo(TZ_INFO)
 
 DEBUG = True # False
 
-def get_db_connection():
-    return psycopg2.connect(
+# connections used at the same time: concurrent Streamlit sessions (one per query) + EVAL_WORKERS of app_rag
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30")) # seconds waiting for a free connection
+
+def create_db_pool():
+    return ThreadedConnectionPool(
+        1,
+        DB_POOL_SIZE,
         host=os.getenv("POSTGRES_HOST", "postgres"),
         database=os.getenv("POSTGRES_DB", "book_reviews"),
         user=os.getenv("POSTGRES_USER", "your_username"),
         password=os.getenv("POSTGRES_PASSWORD", "your_password"),
     )
 
+# connections are reused instead of a new one per query, the pool is created on first use
+resources.register("db_pool", create_db_pool)
+
+
+# getconn() raises PoolError when all connections are in use, callers wait for a free one instead
+db_pool_slots = BoundedSemaphore(DB_POOL_SIZE)
+
+
+def get_db_connection():
+    if not db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"no free database connection after {DB_POOL_TIMEOUT}s (DB_POOL_SIZE={DB_POOL_SIZE})")
+    try:
+        return resources.get("db_pool").getconn()
+    except Exception:
+        db_pool_slots.release()
+        raise
+
+
+def release_db_connection(conn):
+    # back to the pool, an unfinished transaction is rolled back
+    try:
+        resources.get("db_pool").putconn(conn)
+    finally:
+        db_pool_slots.release()
+
 
 def check_table_exists(conn, table_name):
     # Check if table_name Table Exists
@@ -66,6 +100,13 @@ def init_db(force_reset=False):
                 if DEBUG:
                     print(f'Table `conversations` created.')
 
+            # streaming metrics, added to tables created before them
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS first_token_time FLOAT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tokens_per_second FLOAT")
+            # retrieval score gate: answered without LLM calls when the score is too low
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS retrieval_score FLOAT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS gated BOOLEAN NOT NULL DEFAULT FALSE")
+
             if not check_table_exists(conn, "feedback"):
                 cur.execute("""
                     CREATE TABLE feedback (
@@ -79,7 +120,7 @@ def init_db(force_reset=False):
                     print(f'Table `feedback` created.')
         conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def save_conversation(conversation_id, question, answer_data, category, timestamp=None):
@@ -94,8 +135,9 @@ def save_conversation(conversation_id, question, answer_data, category, timestam
                 INSERT INTO conversations 
                 (id, question, answer, category, model_used, response_time, relevance, 
                 relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost,
+                first_token_time, tokens_per_second, retrieval_score, gated, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """,
                 (
                     conversation_id,
@@ -113,12 +155,44 @@ def save_conversation(conversation_id, question, answer_data, category, timestam
                     answer_data["eval_completion_tokens"],
                     answer_data["eval_total_tokens"],
                     answer_data["openai_cost"],
+                    answer_data.get("first_token_time"),
+                    answer_data.get("tokens_per_second"),
+                    answer_data.get("retrieval_score"),
+                    answer_data.get("gated", False),
                     timestamp
                 ),
             )
         conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+
+def update_relevance(conversation_id, relevance, explanation, eval_tokens):
+    # result of the background evaluation, returns False if the conversation isn't saved (yet)
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE conversations
+                SET relevance = %s, relevance_explanation = %s,
+                    eval_prompt_tokens = %s, eval_completion_tokens = %s, eval_total_tokens = %s
+                WHERE id = %s
+                """,
+                (
+                    relevance,
+                    explanation,
+                    eval_tokens["prompt_tokens"],
+                    eval_tokens["completion_tokens"],
+                    eval_tokens["total_tokens"],
+                    conversation_id,
+                ),
+            )
+            updated = cur.rowcount > 0
+        conn.commit()
+        return updated
+    finally:
+        release_db_connection(conn)
 
 
 def save_feedback(conversation_id, feedback, timestamp=None):
@@ -134,7 +208,7 @@ def save_feedback(conversation_id, feedback, timestamp=None):
             )
         conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def get_recent_conversations(limit=5, relevance=None):
@@ -153,7 +227,7 @@ def get_recent_conversations(limit=5, relevance=None):
             cur.execute(query, (limit,))
             return cur.fetchall()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def get_feedback_stats():
@@ -168,7 +242,7 @@ def get_feedback_stats():
             """)
             return cur.fetchone()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def check_timezone():
@@ -217,8 +291,4 @@ def check_timezone():
         print(f"An error occurred: {e}")
         conn.rollback()
     finally:
-        conn.close()
-
-
-if RUN_TIMEZONE_CHECK:
-    check_timezone()
+        release_db_connection(conn)
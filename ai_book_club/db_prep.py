@@ -1,9 +1,6 @@
-import os
 from dotenv import load_dotenv
 
-os.environ["RUN_TIMEZONE_CHECK"] = "0"
-
-from db import init_db
+from db import init_db, check_timezone, RUN_TIMEZONE_CHECK
 
 load_dotenv()
 
@@ -11,3 +8,5 @@ if __name__ == "__main__":
     print("Initializing database...")
     init_db(force_reset=False) # use force_reinit=True to reset tables
     print(" Database initialization finished.")
+    if RUN_TIMEZONE_CHECK:
+        check_timezone()
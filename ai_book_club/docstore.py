@@ -0,0 +1,86 @@
+"""
+Memory-mapped document storage of the search index snapshots (minsearch, vectorsearch).
+
+Documents are stored as one UTF-8 JSON blob with row offsets and decoded on access, so processes
+loading the same snapshot share them through the page cache instead of holding a copy each.
+"""
+import os
+import json
+
+import numpy as np
+
+
+class DocStore:
+    """
+    Read-only list of documents stored in a blob, memory-mapped.
+
+    Documents added after loading are kept in memory.
+    """
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._size = len(offsets) - 1
+        self._added = []
+
+    def __len__(self):
+        return self._size + len(self._added)
+
+    def __getitem__(self, row):
+        row = int(row)
+        if row < 0:
+            row += len(self)
+        if row >= self._size:
+            return self._added[row - self._size]
+        return json.loads(self._blob[self._offsets[row]:self._offsets[row + 1]].tobytes())
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def extend(self, docs):
+        self._added.extend(docs)
+
+
+def pack_documents(docs):
+    """
+    Encodes documents into the (blob, offsets) arrays of a DocStore.
+
+    A DocStore without added documents is returned as is, its blob isn't decoded.
+    """
+    if isinstance(docs, DocStore) and not docs._added:
+        return docs._blob, docs._offsets
+    blobs = [json.dumps(doc).encode("utf-8") for doc in docs]
+    return np.frombuffer(b"".join(blobs), dtype=np.uint8), np.cumsum([0] + [len(blob) for blob in blobs], dtype=np.int64)
+
+
+class DocStoreWriter:
+    """
+    Appends documents to a blob file, so a corpus can be collected without holding it in memory.
+
+    close() returns the DocStore of the documents written, memory-mapped from the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._offsets = [0]
+
+    def append(self, doc):
+        data = json.dumps(doc).encode("utf-8")
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def close(self):
+        self._file.close()
+        if self._offsets[-1] == 0: # an empty file can't be memory-mapped
+            blob = np.empty(0, dtype=np.uint8)
+        else:
+            blob = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return DocStore(blob, np.array(self._offsets, dtype=np.int64))
+
+    def remove(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+KEY_SIZE = 16 # bytes of blake2b digest
+
+
+class EmbeddingCache:
+    """
+    An append-only on-disk cache of embeddings, keyed by the hash of model name + text.
+
+    Rows are appended to a raw float32 file that is memory-mapped for reads,
+    their keys to a file of fixed-size digests loaded into a dict when the cache is opened.
+    Every model has its own subdirectory, so embeddings of different dimensions never share a file.
+    Re-encoding a corpus only encodes texts that are new or changed. Intended for a single writer.
+
+    Attributes:
+        path (str): Cache directory of the model.
+        model_name (str): Name of the model, part of every key.
+        dim (int): Embedding dimension, set by the first stored embedding.
+        hits (int): Number of texts found in the cache.
+        misses (int): Number of texts encoded.
+    """
+
+    def __init__(self, path, model_name):
+        """
+        Opens (or creates) a cache directory.
+
+        Args:
+            path (str): Cache root directory, the model's subdirectory is created in it.
+            model_name (str): Name of the model the embeddings come from.
+
+        Raises:
+            ValueError: If the cache directory holds embeddings of another model.
+        """
+        path = os.path.join(path, model_name.replace("/", "__"))
+        self.path = path
+        self.model_name = model_name
+        self.dim = None
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._keys_path = os.path.join(path, "keys.bin")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._rows = {}
+        self._matrix = None
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "rt") as f_in:
+                meta = json.load(f_in)
+            if meta["model_name"] != model_name:
+                raise ValueError(f"{path} holds embeddings of {meta['model_name']}, not {model_name}")
+            self.dim = meta["dim"]
+            self._open()
+
+    def _open(self):
+        # an interrupted append may leave keys without vectors or the opposite: keep complete rows only
+        row_size = self.dim * 4
+        n_rows = min(os.path.getsize(self._keys_path) // KEY_SIZE, os.path.getsize(self._vectors_path) // row_size)
+        os.truncate(self._keys_path, n_rows * KEY_SIZE)
+        os.truncate(self._vectors_path, n_rows * row_size)
+
+        with open(self._keys_path, "rb") as f_in:
+            keys = f_in.read()
+        self._rows = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(n_rows)}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def key(self, text):
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode(), digest_size=KEY_SIZE).digest()
+
+    def _vectors(self):
+        # re-mapped when rows were appended since the last read
+        if self._matrix is None or len(self._matrix) != len(self._rows):
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(len(self._rows), self.dim))
+        return self._matrix
+
+    def get_many(self, texts):
+        """
+        Looks up embeddings of texts.
+
+        Args:
+            texts (list of str): Texts to look up.
+
+        Returns:
+            tuple: (n_texts x dim float32 array with zero rows for missing texts or None if nothing is cached,
+                list of indices of missing texts).
+        """
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32), []
+        rows = [self._rows.get(self.key(text)) for text in texts]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if len(missing) == len(texts):
+            return None, missing
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        found = [i for i, row in enumerate(rows) if row is not None]
+        vectors[found] = self._vectors()[[rows[i] for i in found]]
+        return vectors, missing
+
+    def put_many(self, texts, vectors):
+        """
+        Stores embeddings of texts, already cached texts are skipped.
+
+        Args:
+            texts (list of str): Texts.
+            vectors (array-like): n_texts x dim embeddings.
+
+        Raises:
+            ValueError: If the embeddings don't have the dimension of the cached ones.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Got {vectors.shape[1]}-dimensional embeddings for a cache of {self.dim}-dimensional ones ({self.path})")
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self._meta_path, "wt") as f_out:
+                json.dump({"dim": self.dim, "model_name": self.model_name}, f_out)
+            open(self._keys_path, "ab").close()
+            open(self._vectors_path, "ab").close()
+
+        new_keys, new_rows = [], []
+        seen = set()
+        for text, vector in zip(texts, vectors):
+            key = self.key(text)
+            if key not in self._rows and key not in seen:
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(vector)
+        if not new_keys:
+            return
+
+        # vectors first: keys without vectors would be dropped on open anyway
+        with open(self._vectors_path, "ab") as f_out:
+            f_out.write(np.ascontiguousarray(new_rows, dtype=np.float32).tobytes())
+        with open(self._keys_path, "ab") as f_out:
+            f_out.write(b"".join(new_keys))
+        for key in new_keys:
+            self._rows[key] = len(self._rows)
+
+    def encode(self, model, texts, batch_size=32):
+        """
+        Returns embeddings of texts, encoding only those not cached yet.
+
+        Args:
+            model: Model with a SentenceTransformer-like encode(texts, batch_size=...) method.
+            texts (list of str): Texts to encode.
+            batch_size (int): Encoding batch size.
+
+        Returns:
+            np.ndarray: n_texts x dim float32 embeddings.
+        """
+        vectors, missing = self.get_many(texts)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return vectors
+
+        missing_texts = [texts[i] for i in missing]
+        encoded = np.asarray(model.encode(missing_texts, batch_size=batch_size), dtype=np.float32)
+        self.put_many(missing_texts, encoded)
+        if vectors is None:
+            return encoded
+        vectors[missing] = encoded
+        return vectors
@@ -0,0 +1,131 @@
+import os
+import importlib.util
+
+import numpy as np
+
+
+# torch: fp32 SentenceTransformer | torch-int8: dynamic int8 quantized Linear layers | onnx: ONNX Runtime
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0")) # 0: library default (all cores)
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "data/onnx")
+
+BACKENDS = ["torch", "torch-int8", "onnx"]
+
+
+def encoder_name(model_name, backend=ENCODER_BACKEND):
+    # embeddings of different backends differ slightly, e.g. they are cached separately
+    return model_name if backend == "torch" else f"{model_name}/{backend}"
+
+
+def available_backends():
+    backends = ["torch", "torch-int8"]
+    if importlib.util.find_spec("onnxruntime") is not None:
+        backends.append("onnx")
+    return backends
+
+
+class OnnxEncoder:
+    """
+    SentenceTransformer-compatible encode() running the transformer with ONNX Runtime.
+
+    The transformer is exported once to ONNX_MODEL_PATH, pooling (mean) and normalization
+    are done in numpy like the SentenceTransformer modules they replace.
+    """
+
+    def __init__(self, model_name, threads=ENCODER_THREADS, model_path=ONNX_MODEL_PATH):
+        import onnxruntime as ort
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_name, device="cpu")
+        transformer, pooling = model[0], model[1]
+        if not pooling.pooling_mode_mean_tokens:
+            raise ValueError(f"{model_name}: only mean pooling is supported by the onnx backend")
+        self.tokenizer = transformer.tokenizer
+        self.max_seq_length = model.max_seq_length
+        self.normalize = any(type(module).__name__ == "Normalize" for module in model)
+
+        onnx_path = os.path.join(model_path, model_name.replace("/", "__") + ".onnx")
+        if not os.path.exists(onnx_path):
+            self._export(transformer.auto_model, onnx_path)
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def _export(self, auto_model, onnx_path):
+        import torch
+
+        print(f"Exporting onnx model: {onnx_path}")
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        sample = self.tokenizer(["onnx export"], return_tensors="pt")
+        input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in sample]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+        auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(
+                auto_model,
+                tuple(sample[name] for name in input_names),
+                onnx_path,
+                input_names=input_names,
+                output_names=["token_embeddings"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+
+    def _encode_batch(self, texts):
+        features = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np")
+        inputs = {name: features[name].astype(np.int64) for name in self.input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        vectors = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors.astype(np.float32)
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        # longest first, batches of similar length need less padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        vectors = np.zeros((0, 0), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            batch = self._encode_batch([texts[i] for i in rows])
+            if start == 0:
+                vectors = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            vectors[rows] = batch
+        return vectors[0] if single else vectors
+
+
+def load_encoder(model_name, backend=ENCODER_BACKEND, threads=ENCODER_THREADS):
+    """
+    Loads a model with a SentenceTransformer-compatible encode(texts, batch_size=...).
+
+    Args:
+        model_name (str): SentenceTransformer model name.
+        backend (str): One of BACKENDS.
+        threads (int): Intra-op threads, 0 keeps the library default.
+
+    Returns:
+        SentenceTransformer or OnnxEncoder.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend}, expected one of {BACKENDS}")
+    print(f"Loading encoder: {model_name} ({backend})")
+
+    if backend == "onnx":
+        return OnnxEncoder(model_name, threads=threads)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        torch.set_num_threads(threads)
+    model = SentenceTransformer(model_name, device="cpu")
+    if backend == "torch-int8":
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
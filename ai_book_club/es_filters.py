@@ -0,0 +1,28 @@
+"""
+Elasticsearch filter clauses of the book reviews index, shared by app_rag.py (search) and
+ingest.py (validation of new index versions), so both filter the same way.
+"""
+
+# fields filtered by a keyword sub-field
+KEYWORD_SUBFIELDS = {"author": "author.keyword"}
+
+
+def filter_clauses(category, filters=None):
+    """
+    Elasticsearch filter clauses: category plus optional structured filters,
+    {field: value} for an exact match or {field: (low, high)} for a range (None for an open bound).
+    """
+    clauses = [{"term": {"category": category}}]
+    for field, value in (filters or {}).items():
+        field = KEYWORD_SUBFIELDS.get(field, field)
+        if isinstance(value, tuple):
+            low, high = value
+            bounds = {}
+            if low is not None:
+                bounds["gte"] = low
+            if high is not None:
+                bounds["lte"] = high
+            clauses.append({"range": {field: bounds}})
+        else:
+            clauses.append({"term": {field: value}})
+    return clauses
@@ -1,15 +1,24 @@
 import os
+import json
+import time
+import shutil
+import hashlib
 from glob import glob
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
 try:
-    from sentence_transformers import SentenceTransformer
-    from elasticsearch import Elasticsearch
+    from elasticsearch import Elasticsearch, helpers
 except:
     pass
 
 import minsearch
+import vectorsearch
+from es_filters import filter_clauses
+from docstore import DocStoreWriter
+from embedding_cache import EmbeddingCache
+from encoders import load_encoder, encoder_name
 
 
 load_dotenv()
@@ -23,44 +32,141 @@ ELASTIC_URL_LOCAL = os.getenv("ELASTIC_URL_LOCAL", "http://localhost:9200")
 INDEX_MODEL_NAME = os.getenv("INDEX_MODEL_NAME", "multi-qa-MiniLM-L6-cos-v1")
 INDEX_NAME = os.getenv("INDEX_NAME", "book-reviews")
 DATA_PATH = os.getenv("DATA_PATH", "data")
+# minsearch index snapshot, shared (memory-mapped) by all processes loading it
+MINSEARCH_PATH = os.getenv("MINSEARCH_PATH", "data/minsearch")
+# local vector index (same embeddings as Elasticsearch), used by app_rag when VECTOR_SEARCH=local
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "data/vectors")
+VECTOR_INDEX_QUANTIZE = os.getenv("VECTOR_INDEX_QUANTIZE", "0") == "1"
+# approximate (IVF) vector index for large corpora, built when VECTOR_SEARCH=ann
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "elastic")
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", "data/ann")
+ANN_LISTS = int(os.getenv("ANN_LISTS", "0")) # 0: sqrt(number of documents)
+# bulk indexing
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "64"))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "1")) # >1: multi-process encoding on cpu cores
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_THREADS = int(os.getenv("BULK_THREADS", "4"))
+# embeddings of already seen reviews are reused on re-index (one subdirectory per model), empty path disables the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embeddings")
+# csv columns used by the app (parent_asin is the id without the review number)
+CSV_DTYPES = {
+    "id": "str",
+    "author": "str",
+    "title": "str",
+    "category": "str",
+    "publication_year": "Int64", # nullable: empty cells are missing values, not parse errors
+    "rating": "float64",
+    "helpful_vote": "Int64",
+    "text": "str",
+}
+CSV_CHUNK_SIZE = int(os.getenv("CSV_CHUNK_SIZE", "1000"))
+# full: recreate the index | incremental: upsert new/changed reviews, delete vanished ones
+INGEST_MODE = os.getenv("INGEST_MODE", "full") # rollback: point the alias to the previous version
+# full rebuilds go to versioned indices (INDEX_NAME-<timestamp>) behind the INDEX_NAME alias
+KEEP_INDEX_VERSIONS = int(os.getenv("KEEP_INDEX_VERSIONS", "3")) # for rollback
+INDEX_REPLICAS = int(os.getenv("INDEX_REPLICAS", "0")) # single node: no replicas
+# copied from evaluation/ by the deploy/init scripts, data/ is the only directory mounted in the container
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-data.csv")
+# category -> author -> titles with review counts and helpful votes, used by app.py for the author list
+CATALOG_PATH = os.getenv("CATALOG_PATH", "data/catalog.json")
+VALIDATION_QUERIES = int(os.getenv("VALIDATION_QUERIES", "20")) # 0: document count check only
+VALIDATION_MIN_HIT_RATE = float(os.getenv("VALIDATION_MIN_HIT_RATE", "0.3"))
 # TODO url?
 BASE_URL = "https://github.com/dmytrovoytko/llm-bookclub/blob/main"
 
-def fetch_documents(data_path=DATA_PATH):
-    print("Fetching documents...")
+def iter_document_batches(data_path=DATA_PATH, batch_size=CSV_CHUNK_SIZE):
+    # streams csv files in chunks of records, memory stays O(batch) instead of O(corpus)
     # # TODO index other dataset files from repo
     # docs_url = relative_url # f"{BASE_URL}/{relative_url}?raw=1"
     # # docs_response = requests.get(docs_url)
     # # documents = docs_response.json()
     # df = pd.read_csv(docs_url)
-    df = pd.DataFrame()
     data_path = data_path.rstrip('/') # prevent //
     qna_files = sorted(glob(data_path+'/book-reviews-*.csv'))
     for file_name in qna_files:
-        df_ = pd.read_csv(file_name) #, index_col=False)
-        print(f' adding {file_name}: {df_.shape[0]} record(s)')
-        df = pd.concat([df, df_]) #,ignore_index=True)
+        records = 0
+        for chunk in pd.read_csv(file_name, usecols=list(CSV_DTYPES), dtype=CSV_DTYPES, chunksize=batch_size):
+            records += chunk.shape[0]
+            # missing values as None (json null for Elasticsearch), not NaN / pd.NA
+            yield chunk.astype(object).where(chunk.notna(), None).to_dict(orient="records")
+        print(f' read {file_name}: {records} record(s)')
+
 
-    documents = df.to_dict(orient="records")
+def fetch_documents(data_path=DATA_PATH):
+    print("Fetching documents...")
+    documents = [doc for batch in iter_document_batches(data_path) for doc in batch]
     print(f" Fetched {len(documents)} document(s)")
     return documents
 
+def build_catalog(batches):
+    catalog = {}
+    for batch in batches:
+        for doc in batch:
+            authors = catalog.setdefault(doc["category"], {})
+            author = authors.setdefault(doc["author"], {"reviews": 0, "helpful_votes": 0, "titles": {}})
+            title = author["titles"].setdefault(doc["title"], {"reviews": 0, "helpful_votes": 0})
+            for stats in [author, title]:
+                stats["reviews"] += 1
+                stats["helpful_votes"] += int(doc.get("helpful_vote") or 0)
+    # sorted, so the app can use it as is
+    return {
+        category: {
+            author: dict(stats, titles=dict(sorted(stats["titles"].items())))
+            for author, stats in sorted(authors.items())
+        }
+        for category, authors in sorted(catalog.items())
+    }
+
+
+def save_catalog(batches, catalog_path=CATALOG_PATH):
+    catalog = build_catalog(batches)
+    # written to a temporary file and renamed: readers never see a partial file
+    os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+    with open(catalog_path + ".tmp", "wt") as f_out:
+        json.dump(catalog, f_out, ensure_ascii=False)
+    os.replace(catalog_path + ".tmp", catalog_path)
+    print(f"Author catalog saved: {catalog_path} ({sum(len(authors) for authors in catalog.values())} author(s))")
+    return catalog
+
 ## MINSEARCH
 
-def load_index(data_path=DATA_PATH):
+MINSEARCH_CONFIG = {
+    "text_fields": ["author", "title", "text"],
+    "keyword_fields": ["id", "category", "author", "publication_year", "rating"],
+    "engine": "fused",
+}
+
+def snapshot_is_stale(index_path, data_path=DATA_PATH, config=MINSEARCH_CONFIG):
+    # returns why the snapshot can't be reused, or None
+    with open(os.path.join(index_path, "meta.json"), "rt") as f_in:
+        meta = json.load(f_in)
+    for name, value in config.items():
+        # e.g. filters on keyword fields missing from the snapshot would be ignored
+        if meta.get(name) != value:
+            return f"{name} {meta.get(name)} != {value}"
+    # csv files changed after the snapshot was saved
+    csv_mtimes = [os.path.getmtime(file_name) for file_name in glob(data_path.rstrip('/') + '/book-reviews-*.csv')]
+    if csv_mtimes and max(csv_mtimes) > os.path.getmtime(os.path.join(index_path, "meta.json")):
+        return "older than csv files"
+    return None
+
+def load_index(data_path=DATA_PATH, index_path=MINSEARCH_PATH, rebuild=False):
+    # reuse the saved snapshot instead of re-reading csv files and refitting
+    if not rebuild and index_path and os.path.exists(os.path.join(index_path, "meta.json")):
+        stale = snapshot_is_stale(index_path, data_path)
+        if not stale:
+            print(f"Loading index snapshot: {index_path}")
+            return minsearch.Index.load(index_path, mmap=True)
+        print(f"Index snapshot {index_path} is stale ({stale}), rebuilding")
+
     documents = fetch_documents(data_path)
 
-    index = minsearch.Index(
-        text_fields=[
-            "author",
-            "title",
-            "text",
-            "category",
-        ],
-        keyword_fields=["id"],
-    )
+    index = minsearch.Index(**MINSEARCH_CONFIG)
 
     index.fit(documents)
+    if index_path:
+        index.save(index_path)
+        print(f" Index snapshot saved: {index_path}")
     return index
 
 ## ELASTIC SEARCH
@@ -73,17 +179,26 @@ def setup_elasticsearch():
         print(f"Setting up Elasticsearch ({ELASTIC_URL_LOCAL})...")
         es_client = Elasticsearch(ELASTIC_URL_LOCAL)
     print(" Connected to Elasticsearch:", es_client.info())
+    return es_client
 
+
+def create_index(es_client, index_name):
     # NB !!! Avoid using the term query for text fields !!!
     index_settings = {
-        "settings": {"number_of_shards": 1, "number_of_replicas": 0},
+        # bulk-load settings, replicas and refresh are enabled once the index is loaded
+        "settings": {"number_of_shards": 1, "number_of_replicas": 0, "refresh_interval": "-1"},
         "mappings": {
             "properties": {
-                "author": {"type": "text"},
+                # author.keyword: exact author filter
+                "author": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
                 "title": {"type": "text"},
                 "text": {"type": "text"},
                 "category": {"type": "keyword"},
                 "id": {"type": "keyword"},
+                "publication_year": {"type": "integer"},
+                "rating": {"type": "float"},
+                "helpful_vote": {"type": "integer"},
+                "content_hash": {"type": "keyword"},
                 "title_text_vector": {
                     "type": "dense_vector",
                     "dims": 384,
@@ -93,34 +208,360 @@ def setup_elasticsearch():
             }
         },
     }
-
+    es_client.indices.create(index=index_name, body=index_settings)
+    print(f"Elasticsearch index '{index_name}' created")
+
+
+def index_versions(es_client, index_name=INDEX_NAME):
+    # versioned indices behind the alias, oldest first (timestamp suffix sorts by time)
+    return sorted(es_client.indices.get(index=f"{index_name}-*", ignore_unavailable=True, allow_no_indices=True))
+
+
+def alias_target(es_client, index_name=INDEX_NAME):
+    if not es_client.indices.exists_alias(name=index_name):
+        return None
+    return list(es_client.indices.get_alias(name=index_name))[0]
+
+
+def set_index_version(es_client, index_name, version):
+    # read by app_rag to invalidate cached answers built from older data
+    es_client.indices.put_mapping(index=index_name, meta={"version": version})
+
+
+def switch_alias(es_client, version, index_name=INDEX_NAME):
+    # one atomic request: search never sees a missing or half-populated index
+    live = alias_target(es_client, index_name)
+    actions = []
+    if live:
+        actions.append({"remove": {"index": live, "alias": index_name}})
+    elif es_client.indices.exists(index=index_name):
+        # index created before versioning, replaced by the alias
+        actions.append({"remove_index": {"index": index_name}})
+    actions.append({"add": {"index": version, "alias": index_name}})
+    es_client.indices.update_aliases(actions=actions)
+    print(f" Alias '{index_name}' -> '{version}'")
+
+
+def prune_versions(es_client, index_name=INDEX_NAME, keep=KEEP_INDEX_VERSIONS):
+    live = alias_target(es_client, index_name)
+    versions = index_versions(es_client, index_name)
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version != live:
+            es_client.indices.delete(index=version)
+            print(f" Deleted old index '{version}'")
+
+
+def validate_index(es_client, version, expected_count, model, ground_truth_path=GROUND_TRUTH_PATH, sample_size=VALIDATION_QUERIES):
+    count = es_client.count(index=version)["count"]
+    if count == 0 or count != expected_count:
+        return f"{count} document(s) in index, expected {expected_count}"
+
+    if not sample_size:
+        return None
+    if not os.path.exists(ground_truth_path):
+        # the alias is switched without checking the new version answers questions
+        print(f" !! WARNING: ground truth not found ({ground_truth_path}), the index is NOT validated with queries."
+              f" Copy evaluation/ground-truth-data.csv there, set GROUND_TRUTH_PATH, or VALIDATION_QUERIES=0 to disable")
+        return None
+    df = pd.read_csv(ground_truth_path)
+    questions = df.sample(n=min(sample_size, df.shape[0]), random_state=1).to_dict(orient="records")
+    vectors = model.encode([q["question"] for q in questions], batch_size=ENCODE_BATCH_SIZE)
+    hits = {"text": 0, "vector": 0}
+    for q, vector in zip(questions, vectors):
+        found = elastic_search_text(q["question"], q["category"], index_name=version, es=es_client)
+        hits["text"] += q["document"] in [doc["id"] for doc in found]
+        found = elastic_search_knn("title_text_vector", vector, q["category"], index_name=version, es=es_client)
+        hits["vector"] += q["document"] in [doc["id"] for doc in found]
+    for search_type, hit_count in hits.items():
+        hit_rate = hit_count / len(questions)
+        print(f" Validation {search_type} hit rate: {hit_rate:.2f} ({len(questions)} question(s))")
+        if hit_rate < VALIDATION_MIN_HIT_RATE:
+            return f"{search_type} hit rate {hit_rate:.2f} < {VALIDATION_MIN_HIT_RATE}"
+    return None
+
+
+def version_timestamp():
+    # milliseconds: rebuilds (or updates) within the same second get different versions, names sort by time
+    now = time.time()
+    return time.strftime("%Y%m%d%H%M%S", time.localtime(now)) + f"{int(now * 1000) % 1000:03d}"
+
+
+def rebuild_index(es_client, batches, model, index_name=INDEX_NAME):
+    # blue/green: load a new version, validate it, then point the alias to it
+    version = f"{index_name}-{version_timestamp()}"
+    while es_client.indices.exists(index=version):
+        time.sleep(0.001)
+        version = f"{index_name}-{version_timestamp()}"
+    create_index(es_client, version)
     try:
-        es_client.indices.delete(index=INDEX_NAME, ignore_unavailable=True)
-    except Exception as e:
-        print('!! es_client.indices.delete:', e)
-    es_client.indices.create(index=INDEX_NAME, body=index_settings)
-    print(f"Elasticsearch index '{INDEX_NAME}' created")
-    return es_client
+        indexed, errors = index_documents(es_client, batches, model, index_name=version)
+        es_client.indices.put_settings(index=version, settings={"index": {"number_of_replicas": INDEX_REPLICAS}})
+        error = validate_index(es_client, version, indexed, model)
+        if error:
+            raise RuntimeError(f"index '{version}' failed validation: {error}, '{index_name}' unchanged")
+        set_index_version(es_client, version, version)
+        switch_alias(es_client, version, index_name)
+    except Exception:
+        # a failed or half-loaded version is never left behind
+        es_client.indices.delete(index=version, ignore_unavailable=True)
+        raise
+    prune_versions(es_client, index_name)
+    return indexed, errors
+
+
+def rollback_index(es_client, index_name=INDEX_NAME):
+    live = alias_target(es_client, index_name)
+    older = [version for version in index_versions(es_client, index_name) if live is None or version < live]
+    if not older:
+        raise RuntimeError(f"no older version of '{index_name}' to roll back to")
+    switch_alias(es_client, older[-1], index_name)
 
 
 def load_model():
-    print(f"Loading model: {INDEX_MODEL_NAME}")
-    return SentenceTransformer(INDEX_MODEL_NAME)
+    # backend (fp32/int8 torch, onnx) and threads: ENCODER_BACKEND, ENCODER_THREADS
+    return load_encoder(INDEX_MODEL_NAME)
 
 
-def index_documents(es_client, documents, model):
-    print("Indexing documents...")
+class PooledEncoder:
+    """
+    Encodes with a pool of SentenceTransformer worker processes, one per cpu worker.
+    """
+
+    def __init__(self, model, workers):
+        # split the cores between workers instead of every worker using all of them
+        os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+        self.model = model
+        self.pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+
+    def encode(self, texts, batch_size=ENCODE_BATCH_SIZE):
+        # longest first, so every chunk sent to a worker holds texts of similar length (less padding)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        vectors = self.model.encode_multi_process([texts[i] for i in order], self.pool, batch_size=batch_size)
+        result = np.empty_like(vectors)
+        result[order] = vectors
+        return result
+
+    def close(self):
+        self.model.stop_multi_process_pool(self.pool)
+
+
+def start_encoder(model, workers=ENCODE_WORKERS):
+    if workers > 1 and hasattr(model, "start_multi_process_pool"):
+        print(f" Starting {workers} encoding worker(s)")
+        return PooledEncoder(model, workers)
+    return model
+
+
+def stop_encoder(encoder):
+    if isinstance(encoder, PooledEncoder):
+        encoder.close()
+
+
+def document_text(doc):
+    return doc["author"] + " " + doc["title"] + " " + doc["text"]
+
+
+embedding_cache = None
+
+
+def get_embedding_cache():
+    # opened once, reading the key index of a large cache for every batch would be O(corpus)
+    global embedding_cache
+    if embedding_cache is None and EMBEDDING_CACHE_PATH:
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, encoder_name(INDEX_MODEL_NAME))
+    return embedding_cache
+
+
+def encode_documents(model, documents, batch_size=ENCODE_BATCH_SIZE, stats=None):
+    # batched encoding, returns documents which couldn't be encoded
+    # stats["encoded"] counts the texts encoded by the model (embedding cache misses)
+    texts, encodable, errors = [], [], []
     for doc in documents:
-        author = doc["author"]
-        title = doc["title"]
-        text = doc["text"]
         try:
-            doc["title_text_vector"] = model.encode(author + " " + title + " " + text).tolist() 
-            es_client.index(index=INDEX_NAME, document=doc)
-        except:
-            print('!!! Failed to index:', author + " " + title + " " + text)
+            texts.append(document_text(doc))
+            encodable.append(doc)
+        except TypeError as e: # missing author/title/text (NaN)
+            errors.append({"id": doc.get("id"), "error": f"encoding: {e}"})
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        misses = cache.misses
+        vectors = cache.encode(model, texts, batch_size=batch_size)
+        encoded = cache.misses - misses
+    else:
+        vectors = model.encode(texts, batch_size=batch_size)
+        encoded = len(texts)
+    if stats is not None:
+        stats["encoded"] = stats.get("encoded", 0) + encoded
+    for doc, vector in zip(encodable, vectors):
+        doc["title_text_vector"] = vector.tolist()
+    return errors
 
-    print(f" Indexed {len(documents)} documents")
+
+def content_hash(doc):
+    # hash of the csv row and the encoder, detects reviews to re-encode on incremental re-index
+    # (all of them after INDEX_MODEL_NAME or ENCODER_BACKEND changes)
+    data = {"doc": doc, "encoder": encoder_name(INDEX_MODEL_NAME)}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def bulk_actions(documents, index_name):
+    for doc in documents:
+        if "title_text_vector" in doc:
+            if "content_hash" not in doc:
+                doc["content_hash"] = content_hash({k: v for k, v in doc.items() if k != "title_text_vector"})
+            yield {"_index": index_name, "_id": doc["id"], "_source": doc}
+
+
+def index_documents(es_client, batches, model, index_name=INDEX_NAME, chunk_size=BULK_CHUNK_SIZE, thread_count=BULK_THREADS):
+    # batches of documents are encoded while previous chunks are being sent by the bulk threads
+    print("Indexing documents...")
+    start_time = time.time()
+    errors = []
+    encode_stats = {"encoded": 0, "time": 0.0}
+
+    def actions():
+        for batch in batches:
+            batch_start = time.time()
+            errors.extend(encode_documents(model, batch, stats=encode_stats))
+            encode_stats["time"] += time.time() - batch_start
+            yield from bulk_actions(batch, index_name)
+
+    # no refreshes while loading, the index is refreshed once at the end
+    es_client.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": "-1"}})
+    indexed = 0
+    try:
+        for ok, item in helpers.parallel_bulk(
+            es_client,
+            actions(),
+            chunk_size=chunk_size,
+            thread_count=thread_count,
+            queue_size=thread_count, # bounded: encoded chunks don't pile up in memory
+            raise_on_error=False,
+            raise_on_exception=False,
+        ):
+            if ok:
+                indexed += 1
+            else:
+                result = item.get("index", item)
+                errors.append({"id": result.get("_id"), "error": result.get("error", result.get("exception"))})
+    finally:
+        es_client.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": None}})
+        es_client.indices.refresh(index=index_name)
+
+    elapsed = time.time() - start_time
+    print(f" Indexed {indexed} documents in {elapsed:.1f}s ({indexed / max(elapsed, 1e-9):.0f} docs/sec)")
+    # documents taken from the embedding cache aren't counted
+    print(f" Encoding: {encode_stats['encoded']} documents in {encode_stats['time']:.1f}s "
+          f"({encode_stats['encoded'] / max(encode_stats['time'], 1e-9):.0f} docs/sec)")
+    cache = get_embedding_cache()
+    if cache is not None:
+        print(f" Embedding cache: {cache.hits} hit(s), {cache.misses} encoded, {len(cache)} cached")
+    if errors:
+        print(f'!!! Failed to index {len(errors)} document(s):')
+        for error in errors:
+            print(f'  {error["id"]}: {error["error"]}')
+    return indexed, errors
+
+
+def fetch_indexed_hashes(es_client, index_name=INDEX_NAME):
+    hashes = {}
+    for hit in helpers.scan(es_client, index=index_name, query={"query": {"match_all": {}}}, _source=["content_hash"]):
+        hashes[hit["_id"]] = hit["_source"].get("content_hash")
+    return hashes
+
+
+def changed_batches(batches, indexed_hashes, seen_ids):
+    # only new or changed documents, ids found in csv files are collected into seen_ids
+    for batch in batches:
+        changed = []
+        for doc in batch:
+            doc["content_hash"] = content_hash(doc)
+            seen_ids.add(doc["id"])
+            if indexed_hashes.get(doc["id"]) != doc["content_hash"]:
+                changed.append(doc)
+        if changed:
+            yield changed
+
+
+def delete_documents(es_client, ids, index_name=INDEX_NAME, chunk_size=BULK_CHUNK_SIZE):
+    actions = ({"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in ids)
+    deleted, errors = helpers.bulk(es_client, actions, chunk_size=chunk_size, raise_on_error=False)
+    es_client.indices.refresh(index=index_name)
+    return deleted, errors
+
+
+def update_documents(es_client, batches, model, index_name=INDEX_NAME):
+    # idempotent: unchanged documents are neither encoded nor sent, search keeps serving the index
+    print("Updating documents...")
+    indexed_hashes = fetch_indexed_hashes(es_client, index_name)
+    print(f" {len(indexed_hashes)} document(s) in '{index_name}'")
+    seen_ids = set()
+    indexed, errors = index_documents(es_client, changed_batches(batches, indexed_hashes, seen_ids), model, index_name)
+
+    vanished = [doc_id for doc_id in indexed_hashes if doc_id not in seen_ids]
+    if not seen_ids:
+        # empty/missing data directory: better keep the index than delete everything
+        print("!!! No documents found, skipping deletions")
+        vanished = []
+    deleted = 0
+    if vanished:
+        deleted, _ = delete_documents(es_client, vanished, index_name)
+    if indexed or deleted:
+        set_index_version(es_client, index_name, f"{index_name}-{version_timestamp()}")
+    print(f" Upserted {indexed}, deleted {deleted}, unchanged {len(seen_ids) - indexed - len(errors)} document(s)")
+    return indexed, deleted, errors
+
+
+def save_vector_index(batches, model, index_path=VECTOR_INDEX_PATH):
+    # second pass over the csv files, embeddings come from the embedding cache filled by index_documents
+    # vectors and documents are appended to files batch by batch and memory-mapped, only categories stay in memory
+    print(f"Saving local vector index ({index_path})...")
+    if get_embedding_cache() is None:
+        print(" No embedding cache (EMBEDDING_CACHE_PATH): documents are encoded again")
+    index_path = index_path.rstrip("/")
+    tmp_path = index_path + ".build"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    vectors_path = os.path.join(tmp_path, "vectors.f32")
+    doc_writer = DocStoreWriter(os.path.join(tmp_path, "docs.blob"))
+    categories, dim = [], 0
+    try:
+        with open(vectors_path, "wb") as f_out:
+            for batch in batches:
+                encode_documents(model, batch)
+                encoded = [doc for doc in batch if "title_text_vector" in doc]
+                if not encoded:
+                    continue
+                vectors = np.asarray([doc.pop("title_text_vector") for doc in encoded], dtype=np.float32)
+                f_out.write(vectors.tobytes())
+                dim = vectors.shape[1]
+                for doc in encoded:
+                    doc_writer.append(doc)
+                    categories.append(doc["category"])
+        docs = doc_writer.close()
+        if not categories:
+            print(" No vectors to save")
+            return
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(len(categories), dim))
+
+        # sorted matrix written to the build directory chunk by chunk, then saved with the documents
+        vector_index = vectorsearch.VectorIndex(quantize=VECTOR_INDEX_QUANTIZE)
+        os.makedirs(os.path.join(tmp_path, "exact"))
+        vector_index.fit(docs, vectors, matrix_path=os.path.join(tmp_path, "exact"), categories=categories)
+        vector_index.save(index_path)
+        print(f" Saved {len(categories)} vectors")
+
+        if VECTOR_SEARCH == "ann":
+            print(f"Building approximate vector index ({ANN_INDEX_PATH})...")
+            ann_index = vectorsearch.IVFIndex(quantize=VECTOR_INDEX_QUANTIZE, n_lists=ANN_LISTS or None)
+            os.makedirs(os.path.join(tmp_path, "ann"))
+            ann_index.fit(docs, vectors, matrix_path=os.path.join(tmp_path, "ann"), categories=categories)
+            ann_index.save(ANN_INDEX_PATH)
+            print(f" Saved {ann_index.n_lists} lists")
+    finally:
+        doc_writer.remove()
+        shutil.rmtree(tmp_path, ignore_errors=True)
 
 
 def init_elasticsearch():
@@ -128,10 +569,21 @@ def init_elasticsearch():
     # if you just want to init the db or didn't want to re-index
     print("ElasticSearch: starting the indexing process...")
 
-    documents = fetch_documents()
-    model = load_model()
-    es_client = setup_elasticsearch()
-    index_documents(es_client, documents, model)
+    encoder = start_encoder(load_model())
+    try:
+        es_client = setup_elasticsearch()
+        if INGEST_MODE == "rollback":
+            rollback_index(es_client)
+            return es_client
+        if INGEST_MODE == "incremental" and es_client.indices.exists(index=INDEX_NAME):
+            update_documents(es_client, iter_document_batches(), encoder)
+        else:
+            rebuild_index(es_client, iter_document_batches(), encoder)
+        if VECTOR_SEARCH in ["local", "ann"]:
+            save_vector_index(iter_document_batches(), encoder)
+        save_catalog(iter_document_batches())
+    finally:
+        stop_encoder(encoder)
     # you may consider to comment <end>
 
     # print("Initializing database...")
@@ -142,9 +594,10 @@ def init_elasticsearch():
 
 SEARCH_RESULTS_NUM = 3 # 5
 
+
 # TODO from app_rag import elastic_search_text ? & knn
 # TODO fine tune weights
-def elastic_search_text(query, category, index_name=INDEX_NAME):
+def elastic_search_text(query, category, index_name=INDEX_NAME, es=None, filters=None):
     """
     NB !!! Avoid using the term query for text fields !!!
     By default, Elasticsearch changes the values of text fields during analysis. For example, the default standard analyzer changes text field values as follows:
@@ -163,23 +616,24 @@ def elastic_search_text(query, category, index_name=INDEX_NAME):
                         "type": "best_fields",
                     }
                 },
-                "filter": {"term": {"category": category}},
+                "filter": filter_clauses(category, filters),
             }
         },
     }
 
-    response = es_client.search(index=index_name, body=search_query)
+    response = (es or es_client).search(index=index_name, body=search_query)
     return [hit["_source"] for hit in response["hits"]["hits"]]
 
 
-def elastic_search_knn(field, vector, category, index_name=INDEX_NAME):
+def elastic_search_knn(field, vector, category, index_name=INDEX_NAME, es=None, filters=None):
     # NB !!! Avoid using the term query for text fields !!!
     knn = {
         "field": field,
         "query_vector": vector,
         "k": SEARCH_RESULTS_NUM,
         "num_candidates": 10000,
-        "filter": {"term": {"category": category}},
+        # applied during the knn search, k results match the filters
+        "filter": filter_clauses(category, filters),
     }
 
     search_query = {
@@ -187,7 +641,7 @@ def elastic_search_knn(field, vector, category, index_name=INDEX_NAME):
         "_source": ["author", "title", "text", "category", "id"],
     }
 
-    response = es_client.search(index=index_name, body=search_query)
+    response = (es or es_client).search(index=index_name, body=search_query)
 
     return [hit["_source"] for hit in response["hits"]["hits"]]
 
@@ -213,8 +667,9 @@ if __name__ == "__main__":
             print("!!! ElasticSearch init error:", e)
     else:
         print("MinSearch: Ingesting data...")
-        index = load_index(data_path=DATA_PATH)
+        index = load_index(data_path=DATA_PATH, rebuild=True)
         print(f' Indexed {len(index.docs)} document(s)')
+        save_catalog(iter_document_batches())
 
         if DEBUG:
             # quick test
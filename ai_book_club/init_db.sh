@@ -3,6 +3,7 @@ echo
 echo '1. COPYING LATEST DATASET AND SCRIPTS'
 echo
 cp -r ../data .
+cp ../evaluation/ground-truth-data.csv data/ # questions validating new index versions (ingest.py)
 # cp test.env .env
 
 if [[ -e ".env" ]]
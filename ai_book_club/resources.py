@@ -0,0 +1,69 @@
+"""
+Registry of heavy shared resources (embedding model, clients, db pool).
+
+Resources are created on first use, once per process, and shared by all Streamlit
+sessions (imported modules aren't re-run by Streamlit reruns, like st.cache_resource).
+"""
+import time
+from threading import Lock, Thread
+
+
+factories = {}
+resources = {}
+timings = {} # name -> seconds to create
+locks = {}
+registry_lock = Lock()
+warm_up_thread = None
+
+
+def register(name, factory):
+    with registry_lock:
+        factories[name] = factory
+        locks.setdefault(name, Lock())
+
+
+def get(name):
+    resource = resources.get(name)
+    if resource is not None:
+        return resource
+    # one lock per resource: a slow model load doesn't block other resources
+    with locks[name]:
+        if name not in resources:
+            start_time = time.time()
+            resources[name] = factories[name]()
+            timings[name] = time.time() - start_time
+            print(f"Resource '{name}' created in {timings[name]:.2f}s")
+    return resources[name]
+
+
+def reset(name):
+    with locks[name]:
+        resources.pop(name, None)
+
+
+def warm_up(names=None, background=True):
+    # creates resources ahead of the first request, once per process
+    global warm_up_thread
+
+    def run():
+        start_time = time.time()
+        for name in names or list(factories):
+            try:
+                get(name)
+            except Exception as e:
+                print(f"!! warm up of '{name}' failed: {e}")
+        print(f"Warm up finished in {time.time() - start_time:.2f}s: {report()}")
+
+    with registry_lock:
+        if warm_up_thread is not None:
+            return warm_up_thread
+        warm_up_thread = Thread(target=run, name="warm-up", daemon=True)
+    if background:
+        warm_up_thread.start()
+    else:
+        warm_up_thread.run()
+    return warm_up_thread
+
+
+def report():
+    return {name: round(seconds, 3) for name, seconds in timings.items()}
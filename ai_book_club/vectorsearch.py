@@ -0,0 +1,523 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from docstore import DocStore, pack_documents
+
+# rows upcast at once when scoring an int8-quantized matrix
+SCORE_CHUNK_SIZE = 65536
+
+
+class VectorIndex:
+    """
+    An in-process dense vector index with exact top-k search.
+
+    Embeddings are l2-normalized and kept in one contiguous float32 matrix (optionally int8-quantized
+    with a scale per row), sorted by category so every category is a contiguous row range.
+    A query is scored with one mat-vec over its category range, top results are selected with argpartition.
+
+    Attributes:
+        category_field (str): Document field used to partition rows.
+        quantize (bool): Store int8-quantized embeddings instead of float32.
+        matrix (np.ndarray): n_docs x dim embeddings, float32 or int8.
+        scales (np.ndarray): Per-row dequantization scales (quantized index only).
+        category_ranges (dict): Category -> (first row, end row).
+        docs (list or DocStore): List of documents indexed, in the order given to fit().
+        doc_rows (np.ndarray): Position in docs of the document of every row, None: same order.
+
+    Searches can be restricted with filters on other document fields: {field: value} for an exact match
+    or {field: (low, high)} for a range (bounds included, None for an open bound). Only matching rows are scored.
+    """
+
+    def __init__(self, category_field="category", quantize=False):
+        """
+        Initializes an empty VectorIndex.
+
+        Args:
+            category_field (str): Document field used to partition rows.
+            quantize (bool): Store int8-quantized embeddings (4x less memory, approximate scores).
+        """
+        self.category_field = category_field
+        self.quantize = quantize
+
+        self.matrix = None
+        self.scales = None
+        self.category_ranges = {}
+        self.docs = []
+        self.doc_rows = None
+        self._columns = {} # field -> values in row order, built on first filtered search
+
+    def fit(self, docs, vectors, matrix_path=None, categories=None):
+        """
+        Fits the index with the provided documents and their embeddings.
+
+        The embeddings are normalized and sorted chunk by chunk, a memory-mapped vectors file
+        isn't copied into memory as a whole.
+
+        Args:
+            docs (list of dict or DocStore): List of documents to index.
+            vectors (array-like): n_docs x dim embeddings, in the order of docs.
+            matrix_path (str): Directory the matrix is written to (memory-mapped .npy files) instead of memory.
+            categories (list): Category of every document, read from docs by default.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(docs) != len(vectors):
+            raise ValueError(f"Got {len(vectors)} vectors for {len(docs)} documents")
+
+        if categories is None:
+            categories = [doc.get(self.category_field, "") for doc in docs]
+        categories = np.array([str(category) for category in categories])
+        order = np.argsort(categories, kind="stable")
+        self.docs = docs
+        self.doc_rows = order
+        self.matrix, self.scales = sorted_matrix(vectors, order, self.quantize, matrix_path)
+
+        values, starts = np.unique(categories[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.category_ranges = {value: (int(start), int(end)) for value, start, end in zip(values, starts, ends)}
+        self._columns = {}
+
+        return self
+
+    def _doc(self, row):
+        return self.docs[row if self.doc_rows is None else self.doc_rows[row]]
+
+    def _rows(self, category):
+        if category is None:
+            return 0, len(self.docs)
+        return self.category_ranges.get(category, (0, 0))
+
+    def score(self, vector, start, end):
+        """
+        Computes cosine similarity of the query vector with rows start:end.
+
+        Args:
+            vector (array-like): Query embedding.
+            start (int): First row.
+            end (int): End row (excluded).
+
+        Returns:
+            np.ndarray: Scores of rows start:end.
+        """
+        vector = normalize_vectors(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+        if not self.quantize:
+            return self.matrix[start:end] @ vector
+
+        scores = np.empty(end - start, dtype=np.float32)
+        for chunk in range(start, end, SCORE_CHUNK_SIZE):
+            chunk_end = min(chunk + SCORE_CHUNK_SIZE, end)
+            rows = self.matrix[chunk:chunk_end].astype(np.float32)
+            scores[chunk - start:chunk_end - start] = (rows @ vector) * self.scales[chunk:chunk_end]
+        return scores
+
+    def score_rows(self, vector, rows):
+        """
+        Computes cosine similarity of the query vector with the given rows.
+
+        Args:
+            vector (array-like): Query embedding.
+            rows (np.ndarray): Row ids.
+
+        Returns:
+            np.ndarray: Scores of the rows.
+        """
+        vector = normalize_vectors(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+        if not self.quantize:
+            return self.matrix[rows] @ vector
+
+        scores = np.empty(len(rows), dtype=np.float32)
+        for chunk in range(0, len(rows), SCORE_CHUNK_SIZE):
+            chunk_rows = rows[chunk:chunk + SCORE_CHUNK_SIZE]
+            scores[chunk:chunk + len(chunk_rows)] = (self.matrix[chunk_rows].astype(np.float32) @ vector) * self.scales[chunk_rows]
+        return scores
+
+    def _column(self, field):
+        column = self._columns.get(field)
+        if column is None:
+            values = [self._doc(row).get(field) for row in range(len(self.docs))]
+            try:
+                # numeric fields compare as floats, missing values are nan and never match
+                column = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            except (TypeError, ValueError):
+                column = np.array(values, dtype=object)
+            self._columns[field] = column
+        return column
+
+    def filter_rows(self, rows, filters):
+        """
+        Keeps the rows whose documents match all filters.
+
+        Args:
+            rows (np.ndarray): Row ids.
+            filters (dict): Field -> value, or (low, high) range tuple.
+
+        Returns:
+            np.ndarray: Matching row ids, in the given order.
+        """
+        mask = np.ones(len(rows), dtype=bool)
+        for field, value in filters.items():
+            values = self._column(field)[rows]
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            else:
+                mask &= values == value
+        return rows[mask]
+
+    def _top(self, scores, k):
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+        top_indices = np.argpartition(-scores, k - 1)[:k]
+        return top_indices[np.argsort(-scores[top_indices])]
+
+    def _results(self, rows, scores, k, return_scores):
+        top_indices = self._top(scores, k)
+        docs = [self._doc(rows[i]) for i in top_indices]
+        if return_scores:
+            return docs, scores[top_indices].tolist()
+        return docs
+
+    def search(self, vector, category=None, k=10, filters=None, return_scores=False):
+        """
+        Finds the documents most similar to the query vector.
+
+        Args:
+            vector (array-like): Query embedding, from the same model as the indexed ones.
+            category (str): Optional category to search in, all documents by default.
+            k (int): The number of top results to return. Defaults to 10.
+            filters (dict): Optional filters on other document fields.
+            return_scores (bool): Also return the cosine similarities of the results.
+
+        Returns:
+            list of dict: List of documents ranked by cosine similarity,
+                (documents, scores) if return_scores.
+        """
+        start, end = self._rows(category)
+        if end <= start:
+            return ([], []) if return_scores else []
+
+        if filters:
+            rows = self.filter_rows(np.arange(start, end), filters)
+            scores = self.score_rows(vector, rows)
+        else:
+            rows = np.arange(start, end)
+            scores = self.score(vector, start, end)
+        return self._results(rows, scores, k, return_scores)
+
+    def _params(self):
+        return {"category_field": self.category_field, "quantize": self.quantize}
+
+    def _arrays(self):
+        arrays = {"matrix": self.matrix}
+        if self.doc_rows is not None:
+            arrays["doc_rows"] = self.doc_rows
+        if self.quantize:
+            arrays["scales"] = self.scales
+        return arrays
+
+    def _state(self):
+        return {"category_ranges": self.category_ranges}
+
+    def _set_state(self, state):
+        self.category_ranges = {category: tuple(rows) for category, rows in state["category_ranges"].items()}
+
+    def save(self, path):
+        """
+        Saves the index to a directory, the embeddings and documents as .npy files that load() can memory-map.
+
+        Args:
+            path (str): Index directory, created or replaced.
+        """
+        path = path.rstrip("/")
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        arrays = self._arrays()
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        # one JSON document per row in a blob, see DocStore
+        blob, offsets = pack_documents(self.docs)
+        np.save(os.path.join(tmp_path, "docs.blob.npy"), blob)
+        np.save(os.path.join(tmp_path, "docs.offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "wt") as f_out:
+            meta = {"params": self._params(), "arrays": list(arrays), "state": self._state()}
+            json.dump(meta, f_out, indent=2)
+
+        old_path = path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads an index saved with save().
+
+        Args:
+            path (str): Index directory.
+            mmap (bool): Memory-map the embeddings and documents read-only, shared between processes
+                through the page cache.
+
+        Returns:
+            VectorIndex: The loaded index.
+        """
+        path = path.rstrip("/")
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, "meta.json"), "rt") as f_in:
+            meta = json.load(f_in)
+
+        index = cls(**meta["params"])
+        for name in meta["arrays"]:
+            setattr(index, name, np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode))
+        index._set_state(meta["state"])
+        if os.path.exists(os.path.join(path, "docs.json")): # index saved before DocStore
+            with open(os.path.join(path, "docs.json"), "rt") as f_in:
+                index.docs = json.load(f_in)
+        else:
+            index.docs = DocStore(*(np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                                    for name in ["docs.blob", "docs.offsets"]))
+
+        return index
+
+
+class IVFIndex(VectorIndex):
+    """
+    An approximate nearest-neighbour index (inverted file), pure NumPy.
+
+    Embeddings are clustered with spherical k-means into n_lists lists. Rows are sorted by (list, category),
+    so each list of each category is a contiguous row range. A query only scores the rows of the nprobe
+    lists whose centroids are closest to it (among the lists having rows of the requested category):
+    nprobe trades recall for latency, nprobe == n_lists is exact search.
+
+    Attributes:
+        n_lists (int): Number of lists (k-means clusters).
+        nprobe (int): Default number of lists scored per query.
+        centroids (np.ndarray): n_lists x dim normalized centroids.
+        categories (list): Indexed categories, in code order.
+        offsets (np.ndarray): Row offset of every (list, category) pair, n_lists * n_categories + 1 values.
+    """
+
+    def __init__(self, category_field="category", quantize=False, n_lists=None, nprobe=8, n_iter=20, seed=42):
+        """
+        Initializes an empty IVFIndex.
+
+        Args:
+            category_field (str): Document field used to partition rows.
+            quantize (bool): Store int8-quantized embeddings.
+            n_lists (int): Number of lists, sqrt(n_docs) by default.
+            nprobe (int): Default number of lists scored per query.
+            n_iter (int): K-means iterations.
+            seed (int): Random seed of k-means initialization.
+        """
+        super().__init__(category_field=category_field, quantize=quantize)
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+
+        self.centroids = None
+        self.categories = []
+        self.offsets = None
+
+    def fit(self, docs, vectors, matrix_path=None, categories=None):
+        """
+        Clusters the embeddings and fits the index with the provided documents.
+
+        Args:
+            docs (list of dict or DocStore): List of documents to index.
+            vectors (array-like): n_docs x dim embeddings, in the order of docs.
+            matrix_path (str): Directory the matrix is written to (memory-mapped .npy files) instead of memory.
+            categories (list): Category of every document, read from docs by default.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(docs) != len(vectors):
+            raise ValueError(f"Got {len(vectors)} vectors for {len(docs)} documents")
+
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(docs))))
+        self.n_lists = min(n_lists, len(docs)) or 1
+        self.centroids = kmeans(vectors, self.n_lists, self.n_iter, self.seed)
+        # normalizing a row doesn't change its closest centroid
+        lists = assign_lists(vectors, self.centroids)
+
+        if categories is None:
+            categories = [doc.get(self.category_field, "") for doc in docs]
+        categories = np.array([str(category) for category in categories])
+        self.categories, codes = np.unique(categories, return_inverse=True)
+        self.categories = self.categories.tolist()
+        keys = lists * len(self.categories) + codes
+        order = np.argsort(keys, kind="stable")
+        self.offsets = np.searchsorted(keys[order], np.arange(self.n_lists * len(self.categories) + 1))
+
+        self.docs = docs
+        self.doc_rows = order
+        self.matrix, self.scales = sorted_matrix(vectors, order, self.quantize, matrix_path)
+        self.category_ranges = {}
+        self._columns = {}
+
+        return self
+
+    def search(self, vector, category=None, k=10, nprobe=None, filters=None, return_scores=False):
+        """
+        Finds approximately the documents most similar to the query vector.
+
+        With filters, only the matching rows of the probed lists are scored; when they are fewer than k,
+        all the lists of the category are searched (a selective filter would otherwise miss results).
+
+        Args:
+            vector (array-like): Query embedding, from the same model as the indexed ones.
+            category (str): Optional category to search in, all documents by default.
+            k (int): The number of top results to return. Defaults to 10.
+            nprobe (int): Number of lists to score, self.nprobe by default.
+            filters (dict): Optional filters on other document fields.
+            return_scores (bool): Also return the cosine similarities of the results.
+
+        Returns:
+            list of dict: List of documents ranked by cosine similarity,
+                (documents, scores) if return_scores.
+        """
+        nprobe = nprobe or self.nprobe
+        n_categories = len(self.categories)
+        offsets = self.offsets.reshape(-1)
+        if category is None:
+            starts = offsets[0:-1:n_categories]
+            ends = offsets[n_categories::n_categories]
+        elif category in self.categories:
+            code = self.categories.index(category)
+            starts = offsets[code:-1:n_categories]
+            ends = offsets[code + 1::n_categories]
+        else:
+            return ([], []) if return_scores else []
+
+        # closest lists having rows to search
+        candidates = np.flatnonzero(ends > starts)
+        if len(candidates) == 0:
+            return ([], []) if return_scores else []
+        vector = normalize_vectors(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+        centroid_scores = self.centroids[candidates] @ vector
+        nprobe = min(nprobe, len(candidates))
+        probed = candidates[np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]]
+
+        if filters:
+            rows = self.filter_rows(np.concatenate([np.arange(starts[i], ends[i]) for i in probed]), filters)
+            if len(rows) < k and nprobe < len(candidates):
+                rows = self.filter_rows(np.concatenate([np.arange(starts[i], ends[i]) for i in candidates]), filters)
+            scores = self.score_rows(vector, rows)
+        else:
+            rows = np.concatenate([np.arange(starts[i], ends[i]) for i in probed])
+            scores = np.concatenate([self.score(vector, starts[i], ends[i]) for i in probed])
+
+        return self._results(rows, scores, k, return_scores)
+
+    def _params(self):
+        return {
+            **super()._params(),
+            "n_lists": self.n_lists,
+            "nprobe": self.nprobe,
+            "n_iter": self.n_iter,
+            "seed": self.seed,
+        }
+
+    def _arrays(self):
+        return {**super()._arrays(), "centroids": self.centroids, "offsets": self.offsets}
+
+    def _state(self):
+        return {"categories": self.categories}
+
+    def _set_state(self, state):
+        self.categories = state["categories"]
+
+
+def kmeans(vectors, n_clusters, n_iter=20, seed=42, sample_size=100000):
+    """
+    Spherical k-means (cosine similarity) on a sample of normalized vectors.
+
+    Returns:
+        np.ndarray: n_clusters x dim normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    vectors = normalize_vectors(np.asarray(vectors, dtype=np.float32))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = assign_lists(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        filled = np.flatnonzero(counts)
+        sums[filled] = np.add.reduceat(vectors[order], np.cumsum(counts)[filled] - counts[filled])
+        # re-seed empty clusters with random points
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize_vectors(sums)
+
+    return centroids
+
+
+def assign_lists(vectors, centroids, chunk_size=SCORE_CHUNK_SIZE):
+    """
+    Assigns every vector to its most similar centroid.
+    """
+    labels = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), chunk_size):
+        labels[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return labels
+
+
+def sorted_matrix(vectors, order, quantize=False, path=None, chunk_size=SCORE_CHUNK_SIZE):
+    """
+    Normalized (and optionally quantized) rows vectors[order], computed chunk by chunk.
+
+    Args:
+        path (str): Directory the arrays are written to as memory-mapped .npy files, in memory by default.
+
+    Returns:
+        tuple: (matrix, scales), scales is None when not quantized.
+    """
+    def allocate(name, shape, dtype):
+        if path is None:
+            return np.empty(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+
+    matrix = allocate("matrix", (len(order), vectors.shape[1]), np.int8 if quantize else np.float32)
+    scales = allocate("scales", (len(order),), np.float32) if quantize else None
+    for start in range(0, len(order), chunk_size):
+        end = min(start + chunk_size, len(order))
+        rows = normalize_vectors(np.asarray(vectors[order[start:end]], dtype=np.float32))
+        if quantize:
+            matrix[start:end], scales[start:end] = quantize_vectors(rows)
+        else:
+            matrix[start:end] = rows
+    return matrix, scales
+
+
+def normalize_vectors(vectors):
+    """
+    L2-normalizes rows of a float32 matrix, zero rows stay zero.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_vectors(vectors):
+    """
+    Symmetric int8 quantization with one scale per row.
+
+    Returns:
+        tuple: (int8 matrix, float32 scales), vectors ~= matrix * scales[:, None].
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    matrix = np.round(vectors / scales[:, None]).astype(np.int8)
+    return matrix, scales.astype(np.float32)
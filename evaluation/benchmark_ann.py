@@ -0,0 +1,93 @@
+"""
+Recall vs latency of the IVF (approximate) vector index against exact search.
+
+Uses the embeddings saved by ingest.py (VECTOR_INDEX_PATH) and the questions of ground-truth-data.csv,
+encoded with the same INDEX_MODEL_NAME and ENCODER_BACKEND as the index.
+--copies N adds N jittered copies of every review to emulate a larger corpus.
+
+    python benchmark_ann.py --vectors ../ai_book_club/data/vectors --copies 1000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_book_club"))
+import vectorsearch
+from encoders import load_encoder
+
+
+INDEX_MODEL_NAME = os.getenv("INDEX_MODEL_NAME", "multi-qa-MiniLM-L6-cos-v1")
+
+
+def load_corpus(vectors_path, copies, noise=0.05, seed=42):
+    exact = vectorsearch.VectorIndex.load(vectors_path, mmap=False)
+    vectors = exact.matrix.astype(np.float32)
+    if exact.quantize:
+        vectors = vectors * exact.scales[:, None]
+    # matrix rows are sorted by category, documents are in ingestion order
+    docs = [exact.docs[i] for i in exact.doc_rows] if exact.doc_rows is not None else list(exact.docs)
+    if copies:
+        rng = np.random.default_rng(seed)
+        copied = [vectors + noise * rng.standard_normal(vectors.shape).astype(np.float32) for _ in range(copies)]
+        docs = docs + [dict(doc, id=f"{doc['id']}#{i}") for i in range(copies) for doc in docs]
+        vectors = np.vstack([vectors] + copied)
+    return docs, vectors
+
+
+def run(index, questions, vectors, k, **search_params):
+    results, latencies = [], []
+    for question, vector in zip(questions, vectors):
+        start_time = time.perf_counter()
+        results.append(index.search(vector, question["category"], k, **search_params))
+        latencies.append(time.perf_counter() - start_time)
+    return results, np.array(latencies) * 1000
+
+
+def hit_rate(questions, results):
+    # copies count as hits for the original review
+    return np.mean([q["document"] in [d["id"].split("#")[0] for d in docs] for q, docs in zip(questions, results)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", default="../ai_book_club/data/vectors")
+    parser.add_argument("--ground-truth", default="ground-truth-data.csv")
+    parser.add_argument("--copies", type=int, default=0)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    questions = pd.read_csv(args.ground_truth).to_dict(orient="records")
+    model = load_encoder(INDEX_MODEL_NAME) # ENCODER_BACKEND: torch | torch-int8 | onnx
+    query_vectors = model.encode([q["question"] for q in questions], batch_size=64)
+
+    docs, vectors = load_corpus(args.vectors, args.copies)
+    print(f"Corpus: {len(docs)} vector(s), {len(questions)} question(s), k={args.k}")
+
+    exact = vectorsearch.VectorIndex().fit(docs, vectors)
+    start_time = time.time()
+    ann = vectorsearch.IVFIndex(n_lists=args.n_lists).fit(docs, vectors)
+    print(f"IVF: {ann.n_lists} lists, built in {time.time() - start_time:.1f}s\n")
+
+    exact_results, latencies = run(exact, questions, query_vectors, args.k)
+    print(f"{'search':>12} {'recall@k':>9} {'hit_rate':>9} {'mean ms':>8} {'p95 ms':>8}")
+    print(f"{'exact':>12} {1.0:9.3f} {hit_rate(questions, exact_results):9.3f} "
+          f"{latencies.mean():8.3f} {np.percentile(latencies, 95):8.3f}")
+
+    for nprobe in args.nprobe:
+        results, latencies = run(ann, questions, query_vectors, args.k, nprobe=nprobe)
+        recall = np.mean([
+            len({d["id"] for d in found} & {d["id"] for d in expected}) / max(len(expected), 1)
+            for found, expected in zip(results, exact_results)
+        ])
+        print(f"{f'nprobe={nprobe}':>12} {recall:9.3f} {hit_rate(questions, results):9.3f} "
+              f"{latencies.mean():8.3f} {np.percentile(latencies, 95):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
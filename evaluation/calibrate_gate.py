@@ -0,0 +1,127 @@
+"""
+Calibration of the retrieval score gate of app_rag (GATE_TEXT_SCORE, GATE_VECTOR_SCORE, GATE_HYBRID_SCORE).
+
+Questions of ground-truth-data.csv are the ones the app should answer, off-topic questions (built-in
+or --off-topic file, one per line) the hopeless ones. For every search type and candidate threshold
+it reports the share of questions gated, the recall it costs (drop of the hit rate: ground-truth documents
+retrieved by questions that would be gated) and the LLM time saved per 100 requests (answer + relevance
+evaluation calls skipped for the hopeless share of the traffic).
+
+Scores are measured without author filter and with the author of the ground-truth document as filter
+(as when an author is chosen in the app, documents-with-ids.json gives the authors), the recommended
+threshold keeps the recall loss of both within the limit.
+
+Runs the app retrieval (Elasticsearch or local vector index, same settings as the app), e.g.:
+
+    ELASTIC_URL=http://localhost:9200 python calibrate_gate.py --llm-seconds 25
+"""
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_book_club"))
+import app_rag
+
+
+OFF_TOPIC = [
+    "What is the weather going to be like tomorrow?",
+    "How do I reset my wifi router?",
+    "Who won the football world cup in 2018?",
+    "Give me a recipe for chocolate chip cookies",
+    "How many moons does Jupiter have?",
+    "Translate 'good morning' into Japanese",
+    "What is the capital of Australia?",
+    "How do I fix a flat bicycle tire?",
+    "Write a python function to sort a list",
+    "What time does the supermarket close on Sunday?",
+    "Which smartphone has the best camera?",
+    "How do I get rid of ants in my kitchen?",
+]
+
+
+def retrieval_scores(questions, search_type, author_filter=False):
+    # top retrieval score and whether the ground-truth document is in the context (top CONTEXT_NUM)
+    scores, hits = [], []
+    for q in questions:
+        filters = {"author": q["author"]} if author_filter and q.get("author") else None
+        results, score = app_rag.retrieve(q["question"], q["category"], search_type, filters)
+        scores.append(score if score is not None else -np.inf) # no results: always gated
+        hits.append(q.get("document") in [doc["id"] for doc in results[:app_rag.CONTEXT_NUM]])
+    return np.array(scores), np.array(hits)
+
+
+def candidate_thresholds(positive_scores, negative_scores):
+    finite = lambda scores: scores[np.isfinite(scores)]
+    quantiles = [
+        np.quantile(finite(positive_scores), [0.0, 0.01, 0.02, 0.05, 0.1, 0.2]),
+        np.quantile(finite(negative_scores), [0.5, 0.75, 0.9, 1.0]),
+    ]
+    return np.unique(np.round(np.concatenate(quantiles), 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ground-truth", default="ground-truth-data.csv")
+    parser.add_argument("--documents", default="documents-with-ids.json", help="authors of the ground-truth documents")
+    parser.add_argument("--off-topic", default=None, help="file with off-topic questions, one per line")
+    parser.add_argument("--search-types", nargs="+", default=["Text", "Vector", "Hybrid"])
+    parser.add_argument("--sample", type=int, default=0, help="ground-truth questions used, 0: all")
+    parser.add_argument("--llm-seconds", type=float, default=20.0,
+                        help="average time of the answer + relevance evaluation LLM calls")
+    parser.add_argument("--off-topic-share", type=float, default=0.1,
+                        help="expected share of hopeless questions in the app traffic")
+    parser.add_argument("--max-recall-loss", type=float, default=0.01)
+    args = parser.parse_args()
+    app_rag.DEBUG = False
+
+    df = pd.read_csv(args.ground_truth)
+    if args.sample:
+        df = df.sample(n=min(args.sample, df.shape[0]), random_state=1)
+    with open(args.documents, "rt") as f_in:
+        authors = {doc["id"]: doc["author"] for doc in json.load(f_in)}
+    positives = [dict(q, author=authors.get(q["document"])) for q in df.to_dict(orient="records")]
+    off_topic = list(OFF_TOPIC)
+    if args.off_topic:
+        with open(args.off_topic, "rt") as f_in:
+            off_topic = [line.strip() for line in f_in if line.strip()]
+    # off-topic questions asked about the authors of the ground truth, in turn, within every category
+    category_authors = {
+        category: sorted({q["author"] for q in positives if q["category"] == category and q["author"]}) or [None]
+        for category in app_rag.categories.values()
+    }
+    negatives = [
+        {"question": question, "category": category, "author": names[i % len(names)]}
+        for i, question in enumerate(off_topic) for category, names in category_authors.items()
+    ]
+    print(f"{len(positives)} ground-truth question(s), {len(negatives)} off-topic question(s)\n")
+
+    for search_type in args.search_types:
+        recommended = {}
+        for variant, author_filter in [("no author filter", False), ("author filter", True)]:
+            positive_scores, hits = retrieval_scores(positives, search_type, author_filter)
+            negative_scores, _ = retrieval_scores(negatives, search_type, author_filter)
+            print(f"{search_type}, {variant}: hit rate {hits.mean():.3f}, "
+                  f"median score ground-truth {np.median(positive_scores):.3f} / off-topic {np.median(negative_scores):.3f}")
+            print(f"{'threshold':>10} {'gt gated':>9} {'recall loss':>12} {'off gated':>10} {'saved s/100 req':>16}")
+
+            recommended[variant] = 0.0
+            for threshold in candidate_thresholds(positive_scores, negative_scores):
+                positive_gated = positive_scores < threshold
+                negative_gated = negative_scores < threshold
+                recall_loss = (hits & positive_gated).mean()
+                # only gated hopeless questions are savings, gated ground-truth ones are the recall loss
+                saved = 100 * args.off_topic_share * negative_gated.mean() * args.llm_seconds
+                print(f"{threshold:10.3f} {positive_gated.mean():9.3f} {recall_loss:12.3f} "
+                      f"{negative_gated.mean():10.3f} {saved:16.0f}")
+                if recall_loss <= args.max_recall_loss:
+                    recommended[variant] = max(recommended[variant], threshold)
+            print(f"{variant}: recall loss <= {args.max_recall_loss} up to {recommended[variant]}\n")
+        # the gate applies with and without a chosen author
+        print(f"recommended: GATE_{search_type.upper()}_SCORE={min(recommended.values())}\n")
+
+if __name__ == "__main__":
+    main()
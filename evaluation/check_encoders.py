@@ -0,0 +1,77 @@
+"""
+Accuracy and latency of the encoder backends (ai_book_club/encoders.py) against fp32 torch.
+
+Compares document embeddings (cosine to fp32), retrieval hit rate on ground-truth-data.csv
+and single query encoding latency.
+
+    python check_encoders.py --backends torch torch-int8 onnx
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_book_club"))
+import encoders
+import vectorsearch
+
+
+INDEX_MODEL_NAME = os.getenv("INDEX_MODEL_NAME", "multi-qa-MiniLM-L6-cos-v1")
+
+
+def hit_rate(index, questions, query_vectors, k):
+    return np.mean([
+        q["document"] in [doc["id"] for doc in index.search(vector, q["category"], k)]
+        for q, vector in zip(questions, query_vectors)
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", default="documents-with-ids.json")
+    parser.add_argument("--ground-truth", default="ground-truth-data.csv")
+    parser.add_argument("--backends", nargs="+", default=encoders.available_backends())
+    parser.add_argument("--threads", type=int, default=encoders.ENCODER_THREADS)
+    parser.add_argument("--latency-queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.documents, "rt") as f_in:
+        documents = json.load(f_in)
+    questions = pd.read_csv(args.ground_truth).to_dict(orient="records")
+    texts = [doc["author"] + " " + doc["title"] + " " + doc["text"] for doc in documents]
+    print(f"{len(documents)} document(s), {len(questions)} question(s), k={args.k}\n")
+
+    reference = None
+    print(f"{'backend':>12} {'cos mean':>9} {'cos min':>8} {'hit_rate':>9} {'query ms':>9} {'docs/sec':>9}")
+    for backend in ["torch"] + [b for b in args.backends if b != "torch"]:
+        model = encoders.load_encoder(INDEX_MODEL_NAME, backend=backend, threads=args.threads)
+
+        start_time = time.time()
+        doc_vectors = np.asarray(model.encode(texts, batch_size=64), dtype=np.float32)
+        docs_per_sec = len(texts) / (time.time() - start_time)
+        query_vectors = np.asarray(model.encode([q["question"] for q in questions], batch_size=64), dtype=np.float32)
+
+        latencies = []
+        for q in questions[:args.latency_queries]:
+            start_time = time.perf_counter()
+            model.encode(q["question"])
+            latencies.append(time.perf_counter() - start_time)
+
+        normalized = vectorsearch.normalize_vectors(doc_vectors)
+        if reference is None:
+            reference = normalized
+        cosines = (normalized * reference).sum(axis=1)
+
+        index = vectorsearch.VectorIndex().fit(documents, doc_vectors)
+        print(f"{backend:>12} {cosines.mean():9.4f} {cosines.min():8.4f} "
+              f"{hit_rate(index, questions, query_vectors, args.k):9.3f} "
+              f"{np.mean(latencies) * 1000:9.2f} {docs_per_sec:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""
+Check of the Elasticsearch ingestion of ingest.py against an in-process Elasticsearch stand-in.
+
+The stand-in is a small HTTP server speaking the part of the REST API used by ingest.py (bulk,
+aliases, settings, count, scroll, term/range filtered text and kNN search), so the real
+Elasticsearch client and helpers run unchanged. It covers:
+- bulk indexing: chunked requests, refresh disabled during the load, per document error report
+- blue/green rebuilds: alias switch, pruned old versions, failed validation, rollback
+- incremental re-index: only new/changed documents sent, vanished ones deleted, idempotent re-run
+
+    python check_ingest.py
+"""
+import os
+import re
+import sys
+import json
+import fnmatch
+import hashlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+INDEX_NAME = "check-reviews"
+CHUNK_SIZE = 5
+DIMS = 384
+
+
+class ElasticsearchStandIn(ThreadingHTTPServer):
+    """
+    Elasticsearch REST API subset, state kept in memory.
+
+    Attributes:
+        indices (dict): Index name -> {"docs": {_id: source}, "settings": [...], "meta": {...}}.
+        aliases (dict): Alias -> index name.
+        bulk_requests (list): Number of operations of every bulk request.
+        search_down (bool): Searches return no hits (fails query validation).
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.indices = {}
+        self.aliases = {}
+        self.bulk_requests = []
+        self.search_down = False
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def resolve(self, name):
+        return self.aliases.get(name, name)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def tokens(text):
+    return set(re.findall(r"\w+", str(text or "").lower()))
+
+
+def matches(source, clauses):
+    # term and range filter clauses built by es_filters.filter_clauses
+    for clause in clauses:
+        (kind, condition), = clause.items()
+        (field, value), = condition.items()
+        field_value = source.get(field.removesuffix(".keyword"))
+        if kind == "term" and field_value != value:
+            return False
+        if kind == "range":
+            if field_value is None:
+                return False
+            if "gte" in value and field_value < value["gte"]:
+                return False
+            if "lte" in value and field_value > value["lte"]:
+                return False
+    return True
+
+
+def mapping_error(source):
+    # integer/float fields of the index mapping reject other values, like Elasticsearch
+    for field, kind in [("publication_year", int), ("helpful_vote", int), ("rating", (int, float))]:
+        value = source.get(field)
+        if value is not None and not isinstance(value, kind):
+            return {"type": "mapper_parsing_exception", "reason": f"failed to parse field [{field}]"}
+    return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body=None, status=200):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def request_body(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if self.path.split("?")[0].endswith("_bulk"):
+            return [json.loads(line) for line in data.splitlines() if line.strip()]
+        return json.loads(data) if data else {}
+
+    def parts(self):
+        return [part for part in self.path.split("?")[0].split("/") if part]
+
+    def do_HEAD(self):
+        es = self.server
+        parts = self.parts()
+        if parts[0] == "_alias":
+            return self.send(status=200 if parts[1] in es.aliases else 404)
+        return self.send(status=200 if parts[0] in es.indices or parts[0] in es.aliases else 404)
+
+    def do_GET(self):
+        es = self.server
+        parts = self.parts()
+        if not parts:
+            return self.send({"name": "stand-in", "version": {"number": "8.14.0"}, "tagline": "You Know, for Search"})
+        if parts[0] == "_alias":
+            name = parts[1]
+            if name not in es.aliases:
+                return self.send({"error": f"alias [{name}] missing", "status": 404}, 404)
+            return self.send({es.aliases[name]: {"aliases": {name: {}}}})
+        if parts[-1] in ["_count", "_search"]:
+            return self.do_POST()
+        # indices.get with a wildcard pattern
+        return self.send({name: {} for name in es.indices if fnmatch.fnmatch(name, parts[0])})
+
+    def do_PUT(self):
+        es = self.server
+        parts = self.parts()
+        body = self.request_body()
+        if parts[-1] == "_bulk":
+            return self.bulk(body)
+        index = es.resolve(parts[0])
+        if len(parts) == 1:
+            es.indices[index] = {"docs": {}, "settings": [body.get("settings", {})], "meta": {}}
+            return self.send({"acknowledged": True, "index": index})
+        if index not in es.indices:
+            return self.send({"error": f"no such index [{index}]", "status": 404}, 404)
+        if parts[1] == "_settings":
+            es.indices[index]["settings"].append(body)
+        elif parts[1] == "_mapping":
+            es.indices[index]["meta"] = body.get("_meta", {})
+        return self.send({"acknowledged": True})
+
+    def do_DELETE(self):
+        es = self.server
+        parts = self.parts()
+        if parts[0] == "_search":
+            return self.send({"succeeded": True, "num_freed": 1})
+        for name in parts[0].split(","):
+            es.indices.pop(name, None)
+        return self.send({"acknowledged": True})
+
+    def do_POST(self):
+        es = self.server
+        parts = self.parts()
+        body = self.request_body()
+        if parts[-1] == "_bulk":
+            return self.bulk(body)
+        if parts == ["_aliases"]:
+            with es.lock:
+                for action in body["actions"]:
+                    (kind, params), = action.items()
+                    if kind == "add":
+                        es.aliases[params["alias"]] = params["index"]
+                    elif kind == "remove":
+                        es.aliases.pop(params["alias"], None)
+                    elif kind == "remove_index":
+                        es.indices.pop(params["index"], None)
+            return self.send({"acknowledged": True})
+        if parts == ["_search", "scroll"]:
+            # every scroll returns all hits in the first page
+            return self.send({"_scroll_id": "stand-in", "hits": {"total": {"value": 0}, "hits": []}})
+        index = es.resolve(parts[0])
+        if index not in es.indices:
+            return self.send({"error": f"no such index [{index}]", "status": 404}, 404)
+        docs = es.indices[index]["docs"]
+        if parts[1] == "_refresh":
+            return self.send({"_shards": {"total": 1, "successful": 1, "failed": 0}})
+        if parts[1] == "_count":
+            return self.send({"count": len(docs)})
+        if parts[1] == "_search":
+            return self.search(docs, body)
+        return self.send({"error": f"unsupported request {self.path}", "status": 400}, 400)
+
+    def bulk(self, lines):
+        es = self.server
+        items = []
+        i = 0
+        with es.lock:
+            while i < len(lines):
+                (op, meta), = lines[i].items()
+                docs = es.indices.setdefault(es.resolve(meta["_index"]), {"docs": {}, "settings": [], "meta": {}})["docs"]
+                if op == "delete":
+                    found = docs.pop(meta["_id"], None) is not None
+                    items.append({op: {"_id": meta["_id"], "status": 200 if found else 404}})
+                    i += 1
+                    continue
+                source = lines[i + 1]
+                error = mapping_error(source)
+                if error:
+                    items.append({op: {"_id": meta["_id"], "status": 400, "error": error}})
+                else:
+                    docs[meta["_id"]] = source
+                    items.append({op: {"_id": meta["_id"], "status": 201}})
+                i += 2
+            es.bulk_requests.append(len(items))
+        errors = any(item[op]["status"] >= 300 and op != "delete" for item in items for op in item)
+        return self.send({"took": 1, "errors": errors, "items": items})
+
+    def search(self, docs, body):
+        es = self.server
+        hits = []
+        if "knn" in body:
+            knn = body["knn"]
+            query_vector = np.asarray(knn["query_vector"], dtype=np.float32)
+            for doc_id, source in docs.items():
+                if matches(source, knn.get("filter", [])):
+                    vector = np.asarray(source[knn["field"]], dtype=np.float32)
+                    cosine = float(vector @ query_vector / (np.linalg.norm(vector) * np.linalg.norm(query_vector)))
+                    hits.append((doc_id, (1 + cosine) / 2))
+            size = knn["k"]
+        elif "query" in body and "bool" in body["query"]:
+            query = body["query"]["bool"]
+            words = tokens(query["must"]["multi_match"]["query"])
+            for doc_id, source in docs.items():
+                if matches(source, query.get("filter", [])):
+                    score = len(words & (tokens(source.get("text")) | tokens(source.get("title")) | tokens(source.get("author"))))
+                    if score:
+                        hits.append((doc_id, float(score)))
+            size = body.get("size", 10)
+        else: # match_all, scan
+            hits = [(doc_id, 1.0) for doc_id in docs]
+            size = len(hits) if "scroll" in self.path else body.get("size", 10)
+        if es.search_down:
+            hits = []
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        fields = body.get("_source")
+        results = [
+            {"_id": doc_id, "_score": score,
+             "_source": {k: v for k, v in docs[doc_id].items() if fields is None or k in fields}}
+            for doc_id, score in hits[:size]
+        ]
+        response = {"hits": {"total": {"value": len(hits)}, "hits": results}, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0}}
+        if "scroll" in self.path:
+            response["_scroll_id"] = "stand-in"
+        return self.send(response)
+
+
+class HashingEncoder:
+    """
+    Bag of hashed words, deterministic embeddings: questions share words with their reviews.
+    """
+
+    def encode(self, texts, batch_size=64):
+        single = isinstance(texts, str)
+        vectors = np.zeros((1 if single else len(texts), DIMS), dtype=np.float32)
+        for i, text in enumerate([texts] if single else texts):
+            for word in tokens(text):
+                vectors[i, int(hashlib.md5(word.encode()).hexdigest(), 16) % DIMS] += 1.0
+            vectors[i, 0] += 1e-3 # no zero vector
+        return vectors[0] if single else vectors
+
+
+def sample_documents(n_docs=20):
+    topics = ["money investing wealth", "fitness running health", "habits productivity focus", "physics universe math"]
+    return [
+        {
+            "id": f"doc{i:03d}",
+            "author": f"Author {i % 4}",
+            "title": f"Book {i} about {topics[i % 4]}",
+            "category": ["bm", "hfd", "sh", "sm"][i % 4],
+            "publication_year": 2000 + i,
+            "rating": float(i % 5 + 1),
+            "helpful_vote": i,
+            "text": f"review number {i} {topics[i % 4]} word{i}",
+        }
+        for i in range(n_docs)
+    ]
+
+
+def batches_of(docs, batch_size=7):
+    # fresh copies: ingest.py adds vectors and hashes to the documents it indexes
+    docs = [dict(doc) for doc in docs]
+    return (docs[i:i + batch_size] for i in range(0, len(docs), batch_size))
+
+
+def write_ground_truth(path, docs):
+    with open(path, "wt") as f_out:
+        f_out.write("question,category,document\n")
+        for doc in docs:
+            f_out.write(f"what about {doc['title']} word{int(doc['id'][3:])},{doc['category']},{doc['id']}\n")
+
+
+def check_bulk_indexing(es, es_client, ingest):
+    docs = sample_documents()
+    broken = [
+        dict(docs[0], id="no-text", text=None), # encoding error
+        dict(docs[1], id="bad-year", publication_year="unknown"), # rejected by the mapping
+    ]
+    indexed, errors = ingest.rebuild_index(es_client, batches_of(docs + broken), HashingEncoder(), INDEX_NAME)
+    live = es.aliases[INDEX_NAME]
+    assert indexed == len(docs), indexed
+    assert sorted(error["id"] for error in errors) == ["bad-year", "no-text"], errors
+    assert len(es.indices[live]["docs"]) == len(docs)
+    assert max(es.bulk_requests) <= CHUNK_SIZE and sum(es.bulk_requests) == len(docs) + 1, es.bulk_requests
+    refresh_intervals = [settings["index"].get("refresh_interval", "unset")
+                         for settings in es.indices[live]["settings"] if "index" in settings]
+    assert refresh_intervals[:2] == ["-1", None], refresh_intervals
+    assert es.indices[live]["meta"] == {"version": live}
+    print(f"bulk indexing: {indexed} indexed in {len(es.bulk_requests)} bulk request(s), errors reported: "
+          f"{', '.join(sorted(error['id'] for error in errors))}")
+    return live
+
+
+def failing_batches(docs):
+    yield from batches_of(docs[:10])
+    raise OSError("csv file vanished")
+
+
+def check_blue_green(es, es_client, ingest, first):
+    # back-to-back rebuilds, versions named in the same second
+    docs = sample_documents()
+    ingest.rebuild_index(es_client, batches_of(docs), HashingEncoder(), INDEX_NAME)
+    second = es.aliases[INDEX_NAME]
+    assert second != first and first in es.indices, (first, second)
+
+    ingest.rebuild_index(es_client, batches_of(docs), HashingEncoder(), INDEX_NAME)
+    third = es.aliases[INDEX_NAME]
+    # KEEP_INDEX_VERSIONS=2: the oldest version is pruned
+    assert first not in es.indices and second in es.indices, sorted(es.indices)
+
+    es.search_down = True
+    try:
+        ingest.rebuild_index(es_client, batches_of(docs), HashingEncoder(), INDEX_NAME)
+        raise AssertionError("validation should fail")
+    except RuntimeError as e:
+        print(f" expected failure: {e}")
+    finally:
+        es.search_down = False
+    assert es.aliases[INDEX_NAME] == third and sorted(es.indices) == [second, third], sorted(es.indices)
+
+    # load interrupted: the half-loaded version is deleted too
+    try:
+        ingest.rebuild_index(es_client, failing_batches(docs), HashingEncoder(), INDEX_NAME)
+        raise AssertionError("the load should fail")
+    except OSError as e:
+        print(f" expected failure: {e}")
+    assert es.aliases[INDEX_NAME] == third and sorted(es.indices) == [second, third], sorted(es.indices)
+
+    ingest.rollback_index(es_client, INDEX_NAME)
+    assert es.aliases[INDEX_NAME] == second
+    print(f"blue/green: alias switched and pruned, failed builds kept '{third}', rolled back to '{second}'")
+    return second
+
+
+def check_incremental(es, es_client, ingest, live):
+    docs = sample_documents()
+    changed = [dict(doc, text=doc["text"] + " updated") if doc["id"] == "doc003" else doc for doc in docs]
+    changed = [doc for doc in changed if doc["id"] != "doc005"] + [dict(docs[2], id="doc999", helpful_vote=1)]
+    es.bulk_requests.clear()
+    indexed, deleted, errors = ingest.update_documents(es_client, batches_of(changed), HashingEncoder(), INDEX_NAME)
+    assert (indexed, deleted, errors) == (2, 1, []), (indexed, deleted, errors)
+    stored = es.indices[live]["docs"]
+    assert "doc005" not in stored and "doc999" in stored and stored["doc003"]["text"].endswith("updated")
+    assert es.indices[live]["meta"]["version"] != live # app caches are invalidated
+
+    es.bulk_requests.clear()
+    version = es.indices[live]["meta"]["version"]
+    assert ingest.update_documents(es_client, batches_of(changed), HashingEncoder(), INDEX_NAME) == (0, 0, [])
+    assert es.bulk_requests == [] and es.indices[live]["meta"]["version"] == version
+
+    # vectors of another encoder don't mix with the indexed ones
+    model_name = ingest.INDEX_MODEL_NAME
+    ingest.INDEX_MODEL_NAME = model_name + "-other"
+    try:
+        indexed, deleted, errors = ingest.update_documents(es_client, batches_of(changed), HashingEncoder(), INDEX_NAME)
+    finally:
+        ingest.INDEX_MODEL_NAME = model_name
+    assert (indexed, deleted, errors) == (len(changed), 0, []), (indexed, deleted, errors)
+    print("incremental: 1 changed + 1 new upserted, 1 vanished deleted, re-run sends nothing, new encoder re-encodes all")
+
+
+def main():
+    es = ElasticsearchStandIn().start()
+    with tempfile.TemporaryDirectory() as tmp_path:
+        ground_truth_path = os.path.join(tmp_path, "ground-truth.csv")
+        write_ground_truth(ground_truth_path, sample_documents())
+        # module settings are read on import
+        os.environ.update({
+            "ELASTIC_URL": es.url,
+            "INDEX_NAME": INDEX_NAME,
+            "BULK_CHUNK_SIZE": str(CHUNK_SIZE),
+            "BULK_THREADS": "2",
+            "KEEP_INDEX_VERSIONS": "2",
+            "EMBEDDING_CACHE_PATH": "",
+            "GROUND_TRUTH_PATH": ground_truth_path,
+            "VALIDATION_QUERIES": "10",
+        })
+        # the app module, not a copy next to this script
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_book_club"))
+        import ingest
+
+        es_client = ingest.setup_elasticsearch()
+        first = check_bulk_indexing(es, es_client, ingest)
+        live = check_blue_green(es, es_client, ingest, first)
+        check_incremental(es, es_client, ingest, live)
+    es.shutdown()
+
+
+if __name__ == "__main__":
+    main()
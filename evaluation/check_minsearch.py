@@ -0,0 +1,85 @@
+"""
+Consistency check of minsearch snapshots and incremental updates, for every engine.
+
+An index fitted, saved, loaded (memory-mapped or not) and updated with add_documents()/delete_documents()
+must return the same results as an index fitted and updated in memory.
+
+    python check_minsearch.py
+"""
+import os
+import sys
+import tempfile
+
+# the app module, not the copy next to this script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_book_club"))
+import minsearch
+
+
+TEXT_FIELDS = ["author", "title", "text"]
+KEYWORD_FIELDS = ["id", "category", "author", "publication_year", "rating"]
+
+QUERIES = [
+    ("fish cats", {}),
+    ("fish", {"category": "a"}),
+    ("dogs", {"id": "3"}),
+    ("cats", {"rating": (4, None), "category": "b"}),
+    ("novel", {"publication_year": (2005, 2010)}),
+]
+
+
+def sample_documents(n_docs=300):
+    return [
+        {
+            "id": str(i),
+            "category": "ab"[i % 2],
+            "author": f"Author {i % 5}",
+            "title": f"great novel {i}",
+            "text": "book about cats and dogs " * (i % 3 + 1) + ("fish" if i % 7 == 0 else ""),
+            "publication_year": 2000 + i % 20,
+            "rating": float(i % 5 + 1),
+        }
+        for i in range(n_docs)
+    ]
+
+
+NEW_DOCUMENTS = [
+    {"id": "new", "category": "a", "author": "Author 1", "title": "fish story", "text": "fish fish cats",
+     "publication_year": 2010, "rating": 5.0},
+    # replaces document 3
+    {"id": "3", "category": "b", "author": "Author 3", "title": "dogs", "text": "dogs replaced",
+     "publication_year": 2003, "rating": 4.0},
+]
+
+
+def result_ids(index, query, filter_dict):
+    return [doc["id"] for doc in index.search(query, filter_dict=filter_dict, num_results=5)]
+
+
+def check_engine(engine, path):
+    make_index = lambda: minsearch.Index(text_fields=TEXT_FIELDS, keyword_fields=KEYWORD_FIELDS, engine=engine)
+    docs = sample_documents()
+    expected = make_index().fit(docs)
+    expected.add_documents(NEW_DOCUMENTS)
+    make_index().fit(docs).save(path)
+
+    for mmap in (True, False):
+        index = minsearch.Index.load(path, mmap=mmap)
+        index.add_documents(NEW_DOCUMENTS)
+        for query, filter_dict in QUERIES:
+            found, wanted = result_ids(index, query, filter_dict), result_ids(expected, query, filter_dict)
+            assert found == wanted, f"{engine} mmap={mmap} {query!r} {filter_dict}: {found} != {wanted}"
+        queries, filter_dicts = zip(*QUERIES)
+        assert index.search_batch(list(queries), list(filter_dicts)) == expected.search_batch(list(queries), list(filter_dicts))
+        assert index.delete_documents(["new"]) == 1
+        assert "new" not in [doc["id"] for doc in index.search("fish", num_results=50)]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for engine in minsearch.ENGINES:
+            check_engine(engine, os.path.join(tmp_path, engine))
+            print(f"{engine}: save -> load -> add/delete -> search ok")
+
+
+if __name__ == "__main__":
+    main()
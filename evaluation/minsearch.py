@@ -1,25 +1,63 @@
+import os
+import json
+import shutil
+import threading
+
 import pandas as pd
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 import numpy as np
 
+from docstore import DocStore, pack_documents
+
+
+ENGINES = ("tfidf", "fused", "bm25")
+BM25_PARAMS = {"k1": 1.2, "b": 0.75}
+# max number of queries scored at once by search_batch
+SEARCH_BATCH_SIZE = 512
+# TfidfVectorizer parameters CountVectorizer ("bm25" engine) doesn't take
+TFIDF_ONLY_PARAMS = ("norm", "use_idf", "smooth_idf", "sublinear_tf")
+# incremental updates trigger a background compaction past these limits
+MAX_DELTA_DOCS = 10000
+MAX_DELETED_RATIO = 0.2
+
 
 class Index:
     """
     A simple search index using TF-IDF and cosine similarity for text fields and exact matching for keyword fields.
 
+    Three scoring engines are available:
+        "tfidf": every text field is vectorized and scored separately (one cosine similarity per field).
+        "fused": the per-field TF-IDF matrices are stacked column-wise into one CSR matrix at fit time,
+            so a query is tokenized once and scored with a single sparse mat-vec.
+            Boosts are applied as a diagonal scaling of the query vector, the matrix never changes.
+        "bm25": per-field BM25 with impact scores (idf * saturated, length-normalized tf) precomputed at fit time
+            and stacked column-wise into one CSC matrix, so a query only reads the posting lists of its terms.
+            Field scores are summed with boosts, like "fused".
+
+    Documents can be added, updated and deleted (keyed by id_field) without refitting:
+    new rows are vectorized with the frozen vocabulary into a delta segment, deleted rows are tombstoned.
+    compact() refits the live documents (new vocabulary, no tombstones), it runs in the background
+    when the delta segment or the share of deleted rows grows past MAX_DELTA_DOCS / MAX_DELETED_RATIO.
+
     Attributes:
         text_fields (list): List of text field names to index.
         keyword_fields (list): List of keyword field names to index.
-        vectorizers (dict): Dictionary of TfidfVectorizer instances for each text field.
+        engine (str): Scoring engine, one of ENGINES.
+        vectorizers (dict): Dictionary of TfidfVectorizer (CountVectorizer for "bm25") instances for each text field.
         keyword_df (pd.DataFrame): DataFrame containing keyword field data.
-        text_matrices (dict): Dictionary of TF-IDF matrices for each text field.
-        docs (list): List of documents indexed.
+        keyword_index (dict): Inverted index for each keyword field: value -> sorted array of row ids.
+        text_matrices (dict): Dictionary of TF-IDF matrices for each text field (raw term counts for "bm25").
+        fused_matrix (sparse.spmatrix): Column-stacked scoring matrix: row-normalized TF-IDF (CSR) for "fused",
+            BM25 impacts (CSC) for "bm25", None for "tfidf".
+        docs (list or DocStore): List of documents indexed, including deleted ones until compaction.
     """
 
-    def __init__(self, text_fields, keyword_fields, vectorizer_params={}):
+    def __init__(self, text_fields, keyword_fields, vectorizer_params={}, engine="tfidf", id_field="id", bm25_params={}):
         """
         Initializes the Index with specified text and keyword fields.
 
@@ -27,15 +65,48 @@ class Index:
             text_fields (list): List of text field names to index.
             keyword_fields (list): List of keyword field names to index.
             vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            engine (str): Scoring engine, "tfidf" (default), "fused" or "bm25".
+            id_field (str): Field identifying documents for incremental updates.
+            bm25_params (dict): Optional k1 and b parameters of the "bm25" engine, see BM25_PARAMS.
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}, expected one of {ENGINES}")
+
         self.text_fields = text_fields
         self.keyword_fields = keyword_fields
+        self.vectorizer_params = vectorizer_params
+        self.engine = engine
+        self.id_field = id_field
+        self.bm25_params = {**BM25_PARAMS, **bm25_params}
 
-        self.vectorizers = {field: TfidfVectorizer(**vectorizer_params) for field in text_fields}
+        if engine == "bm25":
+            # raw term counts, idf and tf saturation are part of the BM25 impacts
+            # (a vocabulary is all CountVectorizer needs to transform, e.g. after load())
+            count_params = {key: value for key, value in vectorizer_params.items() if key not in TFIDF_ONLY_PARAMS}
+            self.vectorizers = {field: CountVectorizer(**count_params) for field in text_fields}
+        else:
+            self.vectorizers = {field: TfidfVectorizer(**vectorizer_params) for field in text_fields}
         self.keyword_df = None
+        self.keyword_index = {}
         self.text_matrices = {}
+        self.fused_matrix = None
         self.docs = []
 
+        # "fused" engine lookups, see _fit_fused()
+        self._analyzer = None
+        self._vocabulary = {}
+        self._term_columns = None
+        self._column_fields = None
+        # "bm25" engine statistics, frozen at fit time
+        self._bm25_idf = {}
+        self._bm25_avgdl = {}
+
+        # incremental updates, see add_documents()
+        self._lock = threading.RLock()
+        self._compaction = None # threading.Event of the running compaction, set when it's swapped in
+        self._pending_ops = None
+        self._reset_segments()
+
     def fit(self, docs):
         """
         Fits the index with the provided documents.
@@ -43,54 +114,715 @@ class Index:
         Args:
             docs (list of dict): List of documents to index. Each document is a dictionary.
         """
-        self.docs = docs
+        self.docs = list(docs)
         keyword_data = {field: [] for field in self.keyword_fields}
 
         for field in self.text_fields:
-            texts = [doc.get(field, '') for doc in docs]
+            texts = [doc.get(field, "") for doc in docs]
             self.text_matrices[field] = self.vectorizers[field].fit_transform(texts)
 
         for doc in docs:
             for field in self.keyword_fields:
-                keyword_data[field].append(doc.get(field, ''))
+                keyword_data[field].append(doc.get(field, ""))
 
         self.keyword_df = pd.DataFrame(keyword_data)
+        self._fit_keyword_index()
+
+        if self.engine == "fused":
+            self._fit_fused()
+        elif self.engine == "bm25":
+            self._fit_bm25()
 
+        self._reset_segments()
         return self
 
+    def _reset_segments(self):
+        """
+        Makes all documents the main segment: no delta rows, no tombstones.
+        """
+        self._main_size = len(self.docs)
+        self._delta_text_matrices = {}
+        self._delta_fused_matrix = None
+        self._deleted = np.zeros(len(self.docs), dtype=bool)
+        self._id_rows = {}
+        if self.id_field in self.keyword_index:
+            # from the postings, documents of a loaded snapshot aren't decoded
+            for doc_id, rows in self.keyword_index[self.id_field].items():
+                self._id_rows[doc_id] = int(rows[-1])
+            return
+        for row, doc in enumerate(self.docs):
+            doc_id = doc.get(self.id_field)
+            if doc_id is not None:
+                self._id_rows[doc_id] = row
+
+    def _segments(self):
+        """
+        Lists the searchable segments.
+
+        Returns:
+            list of tuple: (first row, end row, text matrices, fused matrix) for the main and delta segments.
+        """
+        segments = [(0, self._main_size, self.text_matrices, self.fused_matrix)]
+        if len(self.docs) > self._main_size:
+            segments.append((self._main_size, len(self.docs), self._delta_text_matrices, self._delta_fused_matrix))
+        return segments
+
+    def _fit_keyword_index(self):
+        """
+        Partitions row ids by value for every keyword field, so filters select rows without scanning the corpus.
+        """
+        self.keyword_index = {}
+        for field in self.keyword_fields:
+            codes, values = pd.factorize(self.keyword_df[field])
+            rows = np.argsort(codes, kind="stable")
+            # rows are grouped by value and stay sorted within each group (missing values have code -1)
+            bounds = np.searchsorted(codes[rows], np.arange(len(values) + 1))
+            self.keyword_index[field] = {
+                value: rows[bounds[i]:bounds[i + 1]] for i, value in enumerate(values)
+            }
+
+    def _filter_rows(self, filter_dict):
+        """
+        Resolves keyword filters to the matching row ids.
+
+        Args:
+            filter_dict (dict): Dictionary of keyword fields to filter by, values or (low, high) range tuples.
+
+        Returns:
+            np.ndarray or None: Sorted row ids matching all filters (deleted rows excluded),
+                None if no keyword filter applies and nothing is deleted.
+        """
+        rows = None
+        for field, value in filter_dict.items():
+            if field not in self.keyword_fields:
+                continue
+            if isinstance(value, tuple):
+                matches = self._range_rows(field, *value)
+            else:
+                matches = self.keyword_index[field].get(value, np.empty(0, dtype=np.intp))
+            rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+
+        if self._deleted.any():
+            rows = np.flatnonzero(~self._deleted) if rows is None else rows[~self._deleted[rows]]
+        return rows
+
+    def _range_rows(self, field, low=None, high=None):
+        """
+        Row ids whose value of a keyword field is within [low, high], None is an open bound.
+        """
+        postings = self.keyword_index[field]
+        matches = [
+            rows for value, rows in postings.items()
+            if (low is None or value >= low) and (high is None or value <= high)
+        ]
+        if not matches:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(matches))
+
+    def _fit_fused(self):
+        """
+        Stacks the per-field TF-IDF matrices into one CSR matrix and builds a shared term lookup.
+        """
+        # cosine similarity == dot product of l2-normalized rows
+        blocks = [normalize(self.text_matrices[field]) for field in self.text_fields]
+        self.fused_matrix = sparse.hstack(blocks, format="csr")
+        self._build_term_lookup()
+
+    def _fit_bm25(self):
+        """
+        Computes per-field BM25 statistics and stacks the impact scores into one CSC matrix.
+        """
+        n_docs = len(self.docs)
+        blocks = []
+        for field in self.text_fields:
+            counts = self.text_matrices[field]
+            doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+            self._bm25_idf[field] = np.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            self._bm25_avgdl[field] = float(counts.sum() / n_docs) if n_docs else 0.0
+            blocks.append(self._bm25_impacts(field, counts))
+        self.fused_matrix = sparse.hstack(blocks, format="csc")
+        self._build_term_lookup()
+
+    def _bm25_impacts(self, field, counts):
+        """
+        Turns raw term counts of a field into BM25 impact scores.
+
+        Args:
+            field (str): Text field name.
+            counts (sparse.spmatrix): Documents x terms raw counts.
+
+        Returns:
+            sparse.csr_matrix: Documents x terms impact scores.
+        """
+        k1, b = self.bm25_params["k1"], self.bm25_params["b"]
+        impacts = sparse.csr_matrix(counts, dtype=np.float64, copy=True)
+        doc_lengths = np.asarray(impacts.sum(axis=1)).ravel()
+        avgdl = self._bm25_avgdl[field] or 1.0
+        length_norms = k1 * (1 - b + b * doc_lengths / avgdl)
+        tf = impacts.data
+        rows = np.repeat(np.arange(impacts.shape[0]), np.diff(impacts.indptr))
+        impacts.data = self._bm25_idf[field][impacts.indices] * tf * (k1 + 1) / (tf + length_norms[rows])
+        return impacts
+
+    def _build_term_lookup(self):
+        """
+        Maps every term to its fused columns.
+
+        All vectorizers are created with the same parameters, so they share one analyzer:
+        a query is tokenized once and each token is mapped to its column in every field at the same time.
+        """
+        self._vocabulary = {}
+        term_ids, columns, idf_weights = [], [], []
+        column_fields = []
+        offset = 0
+        for position, field in enumerate(self.text_fields):
+            vectorizer = self.vectorizers[field]
+            n_columns = len(vectorizer.vocabulary_)
+            idf = vectorizer.idf_ if getattr(vectorizer, "use_idf", False) else np.ones(n_columns)
+            for term, column in vectorizer.vocabulary_.items():
+                term_ids.append(self._vocabulary.setdefault(term, len(self._vocabulary)))
+                columns.append(offset + column)
+                idf_weights.append(idf[column])
+            column_fields.append(np.full(n_columns, position))
+            offset += n_columns
+
+        # term id -> (fused column, idf) for every field containing the term, idf is 1 for "bm25"
+        self._term_columns = sparse.csr_matrix(
+            (idf_weights, (term_ids, columns)), shape=(len(self._vocabulary), offset)
+        )
+        self._column_fields = np.concatenate(column_fields)
+        self._analyzer = self.vectorizers[self.text_fields[0]].build_analyzer()
+
+    def _fused_query_matrix(self, queries, boost_dict):
+        """
+        Builds the boosted query vectors over the fused columns.
+
+        TF-IDF weights are l2-normalized per field, "bm25" queries are plain term counts.
+
+        Args:
+            queries (list of str): The search query strings.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+
+        Returns:
+            sparse.csr_matrix: n_queries x n_columns query matrix.
+        """
+        vectorizer = self.vectorizers[self.text_fields[0]]
+        query_rows, term_ids = [], []
+        for i, query in enumerate(queries):
+            for token in self._analyzer(query):
+                if token in self._vocabulary:
+                    query_rows.append(i)
+                    term_ids.append(self._vocabulary[token])
+        counts = sparse.csr_matrix(
+            (np.ones(len(term_ids)), (query_rows, term_ids)), shape=(len(queries), len(self._vocabulary))
+        )
+        counts.sum_duplicates()
+        if vectorizer.binary:
+            counts.data[:] = 1.0
+        if getattr(vectorizer, "sublinear_tf", False):
+            counts.data = np.log(counts.data) + 1.0
+        query_matrix = (counts @ self._term_columns).tocsr()
+        fields = self._column_fields[query_matrix.indices]
+
+        if self.engine != "bm25":
+            # per-field l2 normalization of every query
+            n_fields = len(self.text_fields)
+            query_ids = np.repeat(np.arange(len(queries)), np.diff(query_matrix.indptr))
+            groups = query_ids * n_fields + fields
+            norms = np.sqrt(np.bincount(groups, weights=query_matrix.data ** 2, minlength=len(queries) * n_fields))
+            norms[norms == 0] = 1.0
+            query_matrix.data = query_matrix.data / norms[groups]
+
+        # boosts as a diagonal scaling
+        boosts = np.array([boost_dict.get(field, 1) for field in self.text_fields], dtype=np.float64)
+        query_matrix.data = query_matrix.data * boosts[fields]
+        return query_matrix
+
+    def _score(self, queries, boost_dict, rows=None):
+        """
+        Computes relevance scores for the queries.
+
+        Args:
+            queries (list of str): The search query strings.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+            rows (np.ndarray): Optional row ids to score, all documents by default.
+
+        Returns:
+            np.ndarray: n_queries x n_documents (or x len(rows)) matrix of scores.
+        """
+        if self.engine in ("fused", "bm25"):
+            query_matrix = self._fused_query_matrix(queries, boost_dict)
+        else:
+            query_vecs = {field: self.vectorizers[field].transform(queries) for field in self.text_fields}
+
+        parts = []
+        for start, end, text_matrices, fused_matrix in self._segments():
+            segment_rows = None
+            if rows is not None:
+                first, last = np.searchsorted(rows, [start, end])
+                segment_rows = rows[first:last] - start
+                n_rows = len(segment_rows)
+            else:
+                n_rows = end - start
+            if n_rows == 0:
+                continue
+
+            if self.engine == "fused":
+                matrix = fused_matrix if segment_rows is None else fused_matrix[segment_rows]
+                parts.append((query_matrix @ matrix.T).toarray())
+                continue
+            if self.engine == "bm25":
+                # CSC column slicing reads only the postings of the query terms, then only the partition rows are scored
+                columns = np.unique(query_matrix.indices)
+                postings = fused_matrix[:, columns].tocsr()
+                if segment_rows is not None:
+                    postings = postings[segment_rows]
+                parts.append((query_matrix[:, columns] @ postings.T).toarray())
+                continue
+
+            scores = np.zeros((len(queries), n_rows))
+            # Compute cosine similarity for each text field and apply boost
+            for field, query_vec in query_vecs.items():
+                matrix = text_matrices[field] if segment_rows is None else text_matrices[field][segment_rows]
+                sim = cosine_similarity(query_vec, matrix)
+                boost = boost_dict.get(field, 1)
+                scores += sim * boost
+            parts.append(scores)
+
+        return np.hstack(parts) if parts else np.zeros((len(queries), 0))
+
     def search(self, query, filter_dict={}, boost_dict={}, num_results=10, threshold=0.01):
         """
         Searches the index with the given query, filters, and boost parameters.
 
         Args:
             query (str): The search query string.
-            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by.
+            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by,
+                or (low, high) tuples for ranges (bounds included, None for an open bound).
             boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
             num_results (int): The number of top results to return. Defaults to 10.
 
         Returns:
             list of dict: List of documents matching the search criteria, ranked by relevance.
         """
-        query_vecs = {field: self.vectorizers[field].transform([query]) for field in self.text_fields}
-        scores = np.zeros(len(self.docs))
+        with self._lock:
+            return self._search(query, filter_dict, boost_dict, num_results, threshold)
 
-        # Compute cosine similarity for each text field and apply boost
-        for field, query_vec in query_vecs.items():
-            sim = cosine_similarity(query_vec, self.text_matrices[field]).flatten()
-            boost = boost_dict.get(field, 1)
-            scores += sim * boost
+    def _search(self, query, filter_dict, boost_dict, num_results, threshold):
+        # Apply keyword filters: only the matching partition is scored
+        rows = self._filter_rows(filter_dict)
+        if rows is None:
+            rows = np.arange(len(self.docs))
+        if len(rows) == 0:
+            return []
 
-        # Apply keyword filters
-        for field, value in filter_dict.items():
-            if field in self.keyword_fields:
-                mask = self.keyword_df[field] == value
-                scores = scores * mask.to_numpy()
+        scores = self._score([query], boost_dict, rows if len(rows) < len(self.docs) else None)[0]
 
         # Use argpartition to get top num_results indices
+        num_results = min(num_results, len(scores))
         top_indices = np.argpartition(scores, -num_results)[-num_results:]
         top_indices = top_indices[np.argsort(-scores[top_indices])]
 
         # Filter out zero-score results / lower than threshold
-        top_docs = [self.docs[i] for i in top_indices if scores[i] > threshold]
+        top_docs = [self.docs[rows[i]] for i in top_indices if scores[i] > threshold]
+
+        return top_docs
+
+    def search_batch(self, queries, filter_dicts=None, boost_dict={}, num_results=10, threshold=0.01):
+        """
+        Searches the index with many queries at once.
+
+        Queries are vectorized together and scored with one sparse query x document product per field
+        (a single one with the "fused" and "bm25" engines), top results are selected row-wise.
+        Queries sharing the same filters are scored together against their partition only.
+
+        Args:
+            queries (list of str): The search query strings.
+            filter_dicts (list of dict): Optional filters for each query, same format as in search().
+            boost_dict (dict): Dictionary of boost scores for text fields, shared by all queries.
+            num_results (int): The number of top results to return per query. Defaults to 10.
+
+        Returns:
+            list of list of dict: Ranked documents for each query, in the order of queries.
+        """
+        with self._lock:
+            return self._search_batch(queries, filter_dicts, boost_dict, num_results, threshold)
+
+    def _search_batch(self, queries, filter_dicts, boost_dict, num_results, threshold):
+        if filter_dicts is None:
+            filter_dicts = [{}] * len(queries)
+        if len(filter_dicts) != len(queries):
+            raise ValueError(f"Got {len(filter_dicts)} filter_dicts for {len(queries)} queries")
+
+        # group queries by their filters
+        groups = {}
+        for i, filter_dict in enumerate(filter_dicts):
+            key = repr(sorted((filter_dict or {}).items()))
+            groups.setdefault(key, (filter_dict or {}, []))[1].append(i)
+
+        results = [[] for _ in queries]
+        for filter_dict, query_ids in groups.values():
+            rows = self._filter_rows(filter_dict)
+            if rows is None:
+                rows = np.arange(len(self.docs))
+            if len(rows) == 0:
+                continue
+            k = min(num_results, len(rows))
+
+            # bounded chunks of queries keep the dense score matrix small
+            for start in range(0, len(query_ids), SEARCH_BATCH_SIZE):
+                chunk = query_ids[start:start + SEARCH_BATCH_SIZE]
+                scores = self._score(
+                    [queries[i] for i in chunk], boost_dict, rows if len(rows) < len(self.docs) else None
+                )
+                top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                top_scores = np.take_along_axis(scores, top_indices, axis=1)
+                order = np.argsort(-top_scores, axis=1)
+                top_indices = np.take_along_axis(top_indices, order, axis=1)
+                top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+                for i, indices, row_scores in zip(chunk, top_indices, top_scores):
+                    results[i] = [self.docs[rows[j]] for j, score in zip(indices, row_scores) if score > threshold]
+
+        return results
+
+    def save(self, path):
+        """
+        Saves the fitted index to a directory.
+
+        Sparse matrices, vocabularies, idf vectors, keyword postings and documents are written as plain .npy files,
+        so they can be memory-mapped by load(). The snapshot is written next to path and swapped in
+        when complete: processes that have the previous snapshot mapped keep reading it safely.
+
+        Pending incremental updates are compacted first.
+
+        Args:
+            path (str): Snapshot directory, created or replaced.
+        """
+        while True:
+            with self._lock:
+                compaction = self._compaction
+                if compaction is None:
+                    if len(self.docs) > self._main_size or self._deleted.any():
+                        self.compact()
+                    self._save(path)
+                    return
+            # the snapshot of an index being swapped in would mix the old and the fresh one
+            compaction.wait()
+
+    def _save(self, path):
+        path = path.rstrip("/")
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        def save_array(name, array):
+            np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(array))
+
+        def save_matrix(name, matrix):
+            meta["formats"][name] = matrix.format
+            save_array(name + ".data", matrix.data)
+            save_array(name + ".indices", matrix.indices)
+            save_array(name + ".indptr", matrix.indptr)
+
+        meta = {
+            "text_fields": self.text_fields,
+            "keyword_fields": self.keyword_fields,
+            "vectorizer_params": self.vectorizer_params,
+            "engine": self.engine,
+            "id_field": self.id_field,
+            "bm25_params": self.bm25_params,
+            "bm25_avgdl": self._bm25_avgdl,
+            "n_docs": len(self.docs),
+            "shapes": {},
+            "formats": {},
+            "keyword_values": {},
+        }
+        for position, field in enumerate(self.text_fields):
+            vectorizer = self.vectorizers[field]
+            terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+            save_array(f"text_{position}.terms", np.array(terms, dtype=str))
+            if getattr(vectorizer, "use_idf", False):
+                save_array(f"text_{position}.idf", vectorizer.idf_)
+            if field in self._bm25_idf:
+                save_array(f"text_{position}.bm25_idf", self._bm25_idf[field])
+            save_matrix(f"text_{position}", self.text_matrices[field])
+            meta["shapes"][f"text_{position}"] = self.text_matrices[field].shape
+        if self.fused_matrix is not None:
+            save_matrix("fused", self.fused_matrix)
+            meta["shapes"]["fused"] = self.fused_matrix.shape
+
+        for position, field in enumerate(self.keyword_fields):
+            postings = self.keyword_index[field]
+            values = list(postings)
+            rows = [postings[value] for value in values]
+            save_array(f"keyword_{position}.rows", np.concatenate(rows) if rows else np.empty(0, dtype=np.intp))
+            save_array(f"keyword_{position}.offsets", np.cumsum([0] + [len(r) for r in rows]))
+            meta["keyword_values"][field] = [value.item() if isinstance(value, np.generic) else value for value in values]
+
+        # one JSON document per row in a blob, see DocStore
+        blob, offsets = pack_documents(self.docs)
+        save_array("docs.blob", blob)
+        save_array("docs.offsets", offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "wt") as f_out:
+            json.dump(meta, f_out, indent=2)
+
+        old_path = path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads an index saved with save().
+
+        Args:
+            path (str): Snapshot directory.
+            mmap (bool): Memory-map the arrays read-only instead of reading them into memory.
+                Several processes loading the same snapshot then share it through the page cache.
+
+        Returns:
+            Index: The loaded index, ready to search.
+        """
+        path = path.rstrip("/")
+        mmap_mode = "r" if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        def load_matrix(name, shape):
+            arrays = (load_array(name + ".data"), load_array(name + ".indices"), load_array(name + ".indptr"))
+            if meta.get("formats", {}).get(name) == "csc":
+                return sparse.csc_matrix(arrays, shape=tuple(shape), copy=False)
+            return sparse.csr_matrix(arrays, shape=tuple(shape), copy=False)
+
+        with open(os.path.join(path, "meta.json"), "rt") as f_in:
+            meta = json.load(f_in)
+        vectorizer_params = meta["vectorizer_params"]
+        if "ngram_range" in vectorizer_params:
+            vectorizer_params["ngram_range"] = tuple(vectorizer_params["ngram_range"])
+
+        index = cls(
+            meta["text_fields"],
+            meta["keyword_fields"],
+            vectorizer_params,
+            engine=meta["engine"],
+            id_field=meta.get("id_field", "id"),
+            bm25_params=meta.get("bm25_params", {}),
+        )
+        index._bm25_avgdl = meta.get("bm25_avgdl", {})
+        if os.path.exists(os.path.join(path, "docs.json")): # snapshot saved before DocStore
+            with open(os.path.join(path, "docs.json"), "rt") as f_in:
+                index.docs = json.load(f_in)
+        else:
+            index.docs = DocStore(load_array("docs.blob"), load_array("docs.offsets"))
+
+        for position, field in enumerate(index.text_fields):
+            vectorizer = index.vectorizers[field]
+            terms = load_array(f"text_{position}.terms")
+            vectorizer.vocabulary_ = {term: column for column, term in enumerate(terms.tolist())}
+            if getattr(vectorizer, "use_idf", False):
+                vectorizer.idf_ = load_array(f"text_{position}.idf")
+            if field in index._bm25_avgdl:
+                index._bm25_idf[field] = load_array(f"text_{position}.bm25_idf")
+            index.text_matrices[field] = load_matrix(f"text_{position}", meta["shapes"][f"text_{position}"])
+        if "fused" in meta["shapes"]:
+            index.fused_matrix = load_matrix("fused", meta["shapes"]["fused"])
+            index._build_term_lookup()
+
+        for position, field in enumerate(index.keyword_fields):
+            rows = load_array(f"keyword_{position}.rows")
+            offsets = load_array(f"keyword_{position}.offsets")
+            index.keyword_index[field] = {
+                value: rows[offsets[i]:offsets[i + 1]] for i, value in enumerate(meta["keyword_values"][field])
+            }
+        # keyword columns from the postings, documents aren't decoded
+        keyword_data = {}
+        for field in index.keyword_fields:
+            column = np.full(len(index.docs), None, dtype=object)
+            for value, rows in index.keyword_index[field].items():
+                column[rows] = value
+            keyword_data[field] = column
+        index.keyword_df = pd.DataFrame(keyword_data)
+        index._reset_segments()
+
+        return index
+
+    def add_documents(self, docs):
+        """
+        Adds documents without refitting the index.
+
+        New rows are vectorized with the current (frozen) vocabulary into the delta segment,
+        so terms unseen at fit time are only searchable after compact().
+        A document with the id of an indexed one replaces it.
+
+        Args:
+            docs (list of dict): Documents to add.
+        """
+        with self._lock:
+            self._add(docs)
+            if self._pending_ops is not None:
+                self._pending_ops.append(("_add", docs))
+        self._maybe_compact()
+        return self
+
+    def update_documents(self, docs):
+        """
+        Replaces indexed documents by new versions with the same id.
+
+        Args:
+            docs (list of dict): New versions of indexed documents.
+
+        Raises:
+            KeyError: If a document id is not indexed, nothing is updated then.
+        """
+        with self._lock:
+            missing = [doc.get(self.id_field) for doc in docs if doc.get(self.id_field) not in self._id_rows]
+            if missing:
+                raise KeyError(f"Unknown document ids: {missing}")
+        return self.add_documents(docs)
+
+    def delete_documents(self, ids):
+        """
+        Deletes documents by id, unknown ids are ignored.
+
+        Rows are tombstoned: they are skipped by searches and dropped by the next compaction.
+
+        Args:
+            ids (list): Ids of the documents to delete.
+
+        Returns:
+            int: Number of deleted documents.
+        """
+        with self._lock:
+            deleted = self._delete(ids)
+            if self._pending_ops is not None:
+                self._pending_ops.append(("_delete", ids))
+        self._maybe_compact()
+        return deleted
+
+    def _add(self, docs):
+        start = len(self.docs)
+        docs = list(docs)
+        if not docs:
+            return
+
+        new_matrices = {
+            field: self.vectorizers[field].transform([doc.get(field, "") for doc in docs]) for field in self.text_fields
+        }
+        for field, matrix in new_matrices.items():
+            delta = self._delta_text_matrices.get(field)
+            self._delta_text_matrices[field] = matrix if delta is None else sparse.vstack([delta, matrix], format="csr")
+        if self.engine == "fused":
+            block = sparse.hstack([normalize(new_matrices[field]) for field in self.text_fields], format="csr")
+            delta = self._delta_fused_matrix
+            self._delta_fused_matrix = block if delta is None else sparse.vstack([delta, block], format="csr")
+        elif self.engine == "bm25":
+            # impacts with the frozen idf and average field lengths
+            block = sparse.hstack([self._bm25_impacts(field, new_matrices[field]) for field in self.text_fields], format="csc")
+            delta = self._delta_fused_matrix
+            self._delta_fused_matrix = block if delta is None else sparse.vstack([delta, block], format="csc")
+
+        for field in self.keyword_fields:
+            postings = self.keyword_index[field]
+            new_rows = {}
+            for row, doc in enumerate(docs, start):
+                value = doc.get(field, "")
+                if not pd.isna(value):
+                    new_rows.setdefault(value, []).append(row)
+            for value, rows in new_rows.items():
+                rows = np.array(rows, dtype=np.intp)
+                postings[value] = np.concatenate([postings[value], rows]) if value in postings else rows
+        self.keyword_df = pd.concat(
+            [self.keyword_df, pd.DataFrame({field: [doc.get(field, "") for doc in docs] for field in self.keyword_fields})],
+            ignore_index=True,
+        )
+
+        self.docs.extend(docs)
+        self._deleted = np.concatenate([self._deleted, np.zeros(len(docs), dtype=bool)])
+        for row, doc in enumerate(docs, start):
+            doc_id = doc.get(self.id_field)
+            if doc_id is None:
+                continue
+            if doc_id in self._id_rows:
+                self._deleted[self._id_rows[doc_id]] = True
+            self._id_rows[doc_id] = row
+
+    def _delete(self, ids):
+        deleted = 0
+        for doc_id in ids:
+            row = self._id_rows.pop(doc_id, None)
+            if row is not None:
+                self._deleted[row] = True
+                deleted += 1
+        return deleted
+
+    def _maybe_compact(self):
+        with self._lock:
+            if self._pending_ops is not None:
+                return
+            delta_docs = len(self.docs) - self._main_size
+            deleted_ratio = self._deleted.mean() if len(self.docs) else 0
+            if delta_docs <= MAX_DELTA_DOCS and deleted_ratio <= MAX_DELETED_RATIO:
+                return
+        self.compact(background=True)
+
+    def compact(self, background=False):
+        """
+        Refits the index on the live documents: merges the delta segment, drops tombstones
+        and rebuilds the vocabularies.
+
+        Searches and updates keep working while the new index is fitted,
+        updates made meanwhile are replayed on it before it is swapped in.
+        When a compaction is already running, it is waited for instead.
+
+        Args:
+            background (bool): Run in a background thread.
+
+        Returns:
+            threading.Thread or Index: The compaction thread if background, else the index itself.
+        """
+        with self._lock:
+            compaction = self._compaction
+            if compaction is None:
+                # updates made from now on are replayed on the fresh index
+                live_docs = [doc for doc, deleted in zip(self.docs, self._deleted) if not deleted]
+                self._pending_ops = []
+                self._compaction = threading.Event()
+
+        if compaction is not None:
+            # already compacting, wait for it instead
+            target, args = compaction.wait, ()
+        else:
+            target, args = self._compact, (live_docs,)
+        if background:
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            return thread
+        target(*args)
+        return self
 
-        return top_docs
\ No newline at end of file
+    def _compact(self, live_docs):
+        try:
+            fresh = Index(
+                self.text_fields,
+                self.keyword_fields,
+                self.vectorizer_params,
+                engine=self.engine,
+                id_field=self.id_field,
+                bm25_params=self.bm25_params,
+            ).fit(live_docs)
+            with self._lock:
+                for method, args in self._pending_ops:
+                    getattr(fresh, method)(args)
+                for name, value in vars(fresh).items():
+                    if name not in ("_lock", "_compaction", "_pending_ops"):
+                        setattr(self, name, value)
+        finally:
+            with self._lock:
+                self._pending_ops = None
+                compaction, self._compaction = self._compaction, None
+            compaction.set()